@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @FileName：     bench_packet.py
+
+"""
+单次探测在构造报文、解析回包上的CPU开销对比：
+    legacy   -> 原send_icmp/receive_icmp的实现：每次拼接payload、两次pack、纯Python校验和、切片解析
+    template -> IcmpPacketTemplate：模板+增量校验和，recv_into缓冲区+memoryview解析
+
+用法: python3 bench/bench_packet.py [-n 次数]
+"""
+
+import os
+import struct
+import sys
+import time
+import timeit
+from getopt import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import check_ip  # noqa: E402
+
+
+def legacy_build_packet(check_id, sequence):
+    """
+    原 Pinger.send_icmp 的报文构造过程
+    """
+    header = struct.pack("bbHHh", check_ip.ICMP_ECHO_REQUEST, 0, 0, check_id, sequence)
+    bytes_In_double = struct.calcsize("d")
+    data = (192 - bytes_In_double) * "Q"
+    data = struct.pack("d", time.time()) + bytes(data.encode('utf-8'))
+    my_checksum = check_ip.Pinger.do_checksum(header + data)
+    header = struct.pack("bbHHh", check_ip.ICMP_ECHO_REQUEST, 0, check_ip.socket.htons(my_checksum), check_id, sequence)
+    return header + data
+
+
+def legacy_parse(recv_packet):
+    """
+    原 Pinger.receive_icmp 的回包解析过程
+    """
+    icmp_header = recv_packet[20:28]
+    type, code, checksum, packet_id, sequence = struct.unpack("bbHHh", icmp_header)
+    bytes_In_double = struct.calcsize("d")
+    return struct.unpack("d", recv_packet[28:28 + bytes_In_double])[0]
+
+
+def reply_packet(packet):
+    """
+    在报文前拼一个20字节的IP头，并把类型改为Echo Reply，模拟raw socket收到的回包
+    """
+    reply = bytearray(b"\x45" + b"\x00" * 19) + bytearray(packet)
+    reply[20] = check_ip.ICMP_ECHO_REPLY
+    return bytes(reply)
+
+
+def main():
+    number = 20000
+    opts, args = getopt(sys.argv[1:], "n:")
+    for opt, arg in opts:
+        if opt == '-n':
+            number = int(arg)
+
+    template = check_ip.get_packet_template(check_ip.DEFAULT_PACKET_SIZE)
+    legacy_reply = reply_packet(legacy_build_packet(1, 1))
+    new_reply = reply_packet(template.build(1, 1, time.time()))
+    recv_buf = bytearray(2048)
+    recv_buf[:len(new_reply)] = new_reply
+    recv_view = memoryview(recv_buf)
+    ip_header_len = (recv_view[0] & 0x0F) * 4
+
+    def template_parse():
+        check_ip.ICMP_HEADER.unpack_from(recv_view, ip_header_len)
+        return check_ip.ICMP_TIMESTAMP.unpack_from(recv_view, ip_header_len + check_ip.ICMP_HEADER.size)[0]
+
+    cases = [
+        ('build legacy', lambda: legacy_build_packet(1234, 5678)),
+        ('build template', lambda: template.build(1234, 5678, time.time())),
+        ('parse legacy', lambda: legacy_parse(legacy_reply)),
+        ('parse template', template_parse),
+    ]
+    print("每个用例执行 %d 次，单位：微秒/次" % number)
+    for name, func in cases:
+        cost = min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+        print("%-16s %8.3f" % (name, cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @FileName：     bench_suite.py
+
+"""
+端到端基准：不向网络发送任何报文，IcmpEngine使用本地的模拟socket，由应答线程按设定的丢包率和延迟回复Echo Reply，
+mtr替换为立即返回的脚本。对每个目标数依次执行：
+    pinger   -> 线程池直接调用 Pinger.ping
+    run_ping -> 线程池调用 CheckIp.run_ping(含写记录、mtr调度)
+    main     -> MainThreading(或--async时AsyncMainThreading)按轮检测，每轮单独计时
+    summary  -> sum_check_result：进程内的在线汇总，以及进程内没有汇总时由记录目录的检查点恢复两种方式
+每项输出耗时、探测数/秒、峰值RSS、峰值fd数，结果保存为JSON，便于不同版本、不同机器之间对比
+
+用法: python3 bench/bench_suite.py [-n 1000,10000] [-l 丢包率] [-d 延迟毫秒] [-c 探测次数] [-w 线程数]
+                                   [-r 轮数] [-o 结果文件] [--async] [--keep]
+"""
+
+import configparser
+import heapq
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from getopt import getopt
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import check_ip  # noqa: E402
+
+
+class IcmpResponder(threading.Thread):
+    def __init__(self, loss=0.0, delay=0.0, seed=1):
+        """
+        ICMP对端的替身：收到的Echo Request按delay延迟后回复，按loss概率丢弃
+        :param loss: 丢包率，0~1
+        :param delay: 回包延迟，单位秒
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.loss = loss
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.answered = 0
+        self.dropped = 0
+        self._pending = []
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def socket(self):
+        """
+        :return: FakeIcmpSocket，作为 set_icmp_socket_factory 的工厂
+        """
+        return FakeIcmpSocket(self)
+
+    def submit(self, fake, packet, addr):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._pending, (time.monotonic() + self.delay, self._seq, fake, bytes(packet), addr))
+            self._cond.notify()
+
+    @staticmethod
+    def reply_packet(packet, addr):
+        """
+        20字节IP头(源地址为目标IP) + 类型改为Echo Reply的原报文，与raw socket收到的回包格式一致
+        """
+        reply = bytearray(20) + bytearray(packet)
+        reply[0] = 0x45
+        reply[9] = socket.IPPROTO_ICMP
+        reply[12:16] = socket.inet_aton(addr)
+        reply[20] = check_ip.ICMP_ECHO_REPLY
+        return reply
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending or self._pending[0][0] > time.monotonic():
+                    self._cond.wait(self._pending[0][0] - time.monotonic() if self._pending else None)
+                due, seq, fake, packet, addr = heapq.heappop(self._pending)
+            try:
+                fake.deliver(self.reply_packet(packet, addr))
+                self.answered += 1
+            except OSError:
+                # 引擎已关闭
+                pass
+
+
+class FakeIcmpSocket(object):
+    def __init__(self, responder):
+        """
+        IcmpEngine所需的socket接口：发送交给IcmpResponder，回包经AF_UNIX数据报socketpair送回，
+        fileno可以交给接收线程阻塞读，也可以注册到asyncio事件循环
+        """
+        self.responder = responder
+        self._rx, self._tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def fileno(self):
+        return self._rx.fileno()
+
+    def setblocking(self, flag):
+        self._rx.setblocking(flag)
+
+    def recv_into(self, buffer):
+        return self._rx.recv_into(buffer)
+
+    def sendto(self, packet, address):
+        self.responder.submit(self, packet, address[0])
+
+    def deliver(self, packet):
+        self._tx.send(packet)
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockopt(self, level, option):
+        return 64
+
+    def close(self):
+        # 关闭不会唤醒阻塞在recv上的接收线程，先shutdown让recv返回
+        self._rx.shutdown(socket.SHUT_RDWR)
+        self._tx.close()
+        self._rx.close()
+
+
+class ResourceMonitor(threading.Thread):
+    def __init__(self, interval=0.05):
+        """
+        定时采样本进程的RSS和打开的fd数，记录区间内的峰值
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self.peak_fds = 0
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def rss_kb():
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        # 非Linux只能取进程生命周期内的峰值
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @staticmethod
+    def fd_count():
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return 0
+
+    def sample(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, self.rss_kb())
+        self.peak_fds = max(self.peak_fds, self.fd_count())
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+def measure(name, size, func):
+    """
+    执行func并记录耗时、探测数、峰值RSS和fd数
+    :param func: 返回附加字段的DICT或None
+    """
+    monitor = ResourceMonitor()
+    monitor.sample()
+    monitor.start()
+    sent = check_ip.PROBES_SENT.value
+    received = check_ip.PROBES_RECEIVED.value
+    start = time.perf_counter()
+    extra = func() or {}
+    elapsed = time.perf_counter() - start
+    monitor.stop()
+    result = dict(scenario=name, targets=size, seconds=round(elapsed, 4),
+                  probes_sent=check_ip.PROBES_SENT.value - sent,
+                  probes_received=check_ip.PROBES_RECEIVED.value - received,
+                  peak_rss_kb=monitor.peak_rss_kb, peak_fds=monitor.peak_fds)
+    result['probes_per_sec'] = round(result['probes_sent'] / elapsed, 1) if elapsed else 0.0
+    result.update(extra)
+    print("%-10s %9d %9.3f秒 %10.1f探测/秒 RSS峰值%8dKB fd峰值%5d" % (
+        name, size, elapsed, result['probes_per_sec'], monitor.peak_rss_kb, monitor.peak_fds))
+    return result
+
+
+def write_ip_file(path, size):
+    """
+    生成size个目标，从10.0.0.1开始连续编号，每行一个IP
+    """
+    start = check_ip.IPV4_ADDRESS.unpack(socket.inet_aton('10.0.0.1'))[0]
+    with open(path, 'w') as f_ip:
+        for n in range(start, start + size):
+            f_ip.write(socket.inet_ntoa(check_ip.IPV4_ADDRESS.pack(n)) + '\n')
+
+
+def write_config(path, mtr_path, count, wait, timeout):
+    """
+    以仓库中的config为基础，替换探测参数，mtr使用外部替身脚本
+    """
+    config = configparser.ConfigParser()
+    config.read(check_ip.DEFAULT_CONFIG_FILE, encoding='utf-8')
+    config['ping'].update(count=str(count), wait=str(wait), timeout=str(timeout), pipeline='1', adaptive='0')
+    config['mtr'].update(path=mtr_path, paras='-r', engine='external', cooldown='0')
+    config['metrics'].update(port='0', snapshot_interval='0')
+    with open(path, 'w', encoding='utf-8') as f_config:
+        config.write(f_config)
+
+
+def write_stub_mtr(path):
+    with open(path, 'w') as f_mtr:
+        f_mtr.write('#!/bin/sh\necho "HOST: bench  Loss%   Snt   Last   Avg  Best  Wrst StDev"\n')
+    os.chmod(path, 0o755)
+
+
+def finish_records(timeout):
+    """
+    等待mtr执行完并把记录写盘
+    """
+    check_ip.wait_mtr_dispatchers(timeout)
+    check_ip.close_result_sinks()
+
+
+def run_size(size, work_dir, options):
+    """
+    对一个目标数执行全部场景
+    """
+    results = []
+    ip_file = os.path.join(work_dir, 'iplist-%d' % size)
+    write_ip_file(ip_file, size)
+    targets = list(check_ip.create_ip_list(ip_file).ips())
+    settings = check_ip.get_settings()
+
+    def pinger():
+        with ThreadPoolExecutor(options['workers']) as executor:
+            replies = executor.map(lambda ip: check_ip.Pinger.from_settings(ip, settings).ping()['Rcvd'], targets)
+            return dict(replies=sum(replies))
+
+    def run_ping():
+        record_dir = os.path.join(work_dir, 'run_ping-%d' % size)
+        os.mkdir(record_dir)
+        with ThreadPoolExecutor(options['workers']) as executor:
+            for _ in executor.map(lambda ip: check_ip.CheckIp(record_dir=record_dir, settings=settings).run_ping(ip),
+                                  targets):
+                pass
+        finish_records(settings.mtr_timeout)
+
+    results.append(measure('pinger', size, pinger))
+    results.append(measure('run_ping', size, run_ping))
+
+    # 异步模式的引擎绑定在每轮的事件循环上，不能沿用线程模式的引擎
+    check_ip.reset_icmp_engine()
+    record_dir = None
+    for r_count in range(1, options['rounds'] + 1):
+        record_dir = os.path.join(work_dir, 'main-%d-%d' % (size, r_count))
+
+        def main_round():
+            if options['async']:
+                thread = check_ip.AsyncMainThreading(options['workers'], record_dir=record_dir, ip_file=ip_file)
+            else:
+                thread = check_ip.MainThreading(threading.Semaphore(options['workers']), record_dir=record_dir,
+                                                ip_file=ip_file, workers=options['workers'])
+            thread.start()
+            thread.join()
+            finish_records(settings.mtr_timeout)
+            check_ip.reset_icmp_engine()
+            return dict(round=r_count, mode='async' if options['async'] else 'threading')
+
+        results.append(measure('main', size, main_round))
+
+    def summary_online():
+        check_ip.CheckIp(record_dir=record_dir, settings=settings).sum_check_result()
+
+    def summary_reload():
+        check_ip._result_aggregators.pop(record_dir, None)
+        check_ip.CheckIp(record_dir=record_dir, settings=settings).sum_check_result()
+        return dict(record_bytes=os.path.getsize(os.path.join(record_dir, 'check-ip-record.csv')))
+
+    results.append(measure('sum_online', size, summary_online))
+    results.append(measure('sum_reload', size, summary_reload))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(BENCH_DIR),
+                                       stderr=subprocess.DEVNULL, encoding='utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    options = {'sizes': [1000, 10000], 'loss': 0.01, 'delay': 5.0, 'count': 3, 'wait': 10, 'timeout': 1,
+               'workers': 256, 'rounds': 2, 'async': False, 'output': None, 'keep': False}
+    opts, args = getopt(sys.argv[1:], "n:l:d:c:w:r:o:", ["async", "keep"])
+    for opt, arg in opts:
+        if opt == '-n':
+            options['sizes'] = [int(size) for size in arg.split(',')]
+        elif opt == '-l':
+            options['loss'] = float(arg)
+        elif opt == '-d':
+            options['delay'] = float(arg)
+        elif opt == '-c':
+            options['count'] = int(arg)
+        elif opt == '-w':
+            options['workers'] = int(arg)
+        elif opt == '-r':
+            options['rounds'] = int(arg)
+        elif opt == '-o':
+            options['output'] = arg
+        elif opt == '--async':
+            options['async'] = True
+        elif opt == '--keep':
+            options['keep'] = True
+    output = options.pop('output') or os.path.join(
+        BENCH_DIR, 'results', 'bench-%s.json' % time.strftime('%Y%m%d%H%M%S'))
+
+    work_dir = tempfile.mkdtemp(prefix='check-ip-bench-')
+    mtr_path = os.path.join(work_dir, 'mtr')
+    config_file = os.path.join(work_dir, 'config')
+    write_stub_mtr(mtr_path)
+    write_config(config_file, mtr_path, options['count'], options['wait'], options['timeout'])
+    check_ip.setup_logging(0)
+    check_ip._settings_watcher = check_ip.SettingsWatcher(config_file)
+
+    responder = IcmpResponder(loss=options['loss'], delay=options['delay'] / 1000.0)
+    responder.start()
+    check_ip.set_icmp_socket_factory(responder.socket)
+    print("目标数 %s，丢包率 %.2f%%，延迟 %.1fms，每个IP %d 个探测，%d 线程，工作目录 %s" % (
+        options['sizes'], options['loss'] * 100, options['delay'], options['count'], options['workers'], work_dir))
+
+    results = []
+    try:
+        for size in options['sizes']:
+            results.extend(run_size(size, work_dir, options))
+    finally:
+        check_ip.reset_icmp_engine()
+        if not options['keep']:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(
+        created=time.strftime('%Y-%m-%d %H:%M:%S'),
+        environment=dict(python=platform.python_version(), implementation=platform.python_implementation(),
+                         platform=platform.platform(), cpu_count=os.cpu_count(), commit=git_commit()),
+        parameters=options,
+        responder=dict(answered=responder.answered, dropped=responder.dropped),
+        results=results)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f_json:
+        json.dump(report, f_json, ensure_ascii=False, indent=2)
+    print("结果己保存: %s" % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,40 +44,143 @@
     ===========================================================================
 """
 
+import asyncio
+import bisect
 import subprocess
 import datetime
 import threading
 import configparser
 import csv
+import ctypes
+import heapq
+import http.server
+import ipaddress
+import json
+import logging
+import logging.handlers
+import math
+import mmap
+import multiprocessing
+import random
 import os
+import queue
 import sys
-import pandas
 from getopt import getopt, GetoptError
 import select
+import shutil
 import socket
 import struct
 import time
 import signal
 import traceback
+import zlib
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACH = 3
+ICMP_TIME_EXCEEDED = 11
+DEFAULT_IDENT_COUNT = 16
 DEFAULT_TIMEOUT = 1
 DEFAULT_COUNT = 5
 DEFAULT_WAIT = 500
+DEFAULT_PACKET_SIZE = 192
+DEFAULT_ADAPTIVE_HEALTHY_ROUNDS = 10
+DEFAULT_ADAPTIVE_HEALTHY_COUNT = 1
+DEFAULT_ADAPTIVE_LOSSY_COUNT = 10
+DEFAULT_DNS_TTL = 300
+DEFAULT_DNS_NEGATIVE_TTL = 30
+DEFAULT_RECORD_BATCH_SIZE = 500
+DEFAULT_RECORD_FLUSH_INTERVAL = 1.0
+DEFAULT_RECORD_FORMAT = 'csv'
+DEFAULT_RECORD_SEGMENT_ROWS = 200000
+DEFAULT_RECORD_CHECKPOINT_INTERVAL = 60
+DEFAULT_SHUTDOWN_TIMEOUT = 10
+DEFAULT_MTR_WORKERS = 4
+DEFAULT_MTR_TIMEOUT = 60
+DEFAULT_MTR_COOLDOWN = 300
+DEFAULT_MTR_COLLAPSE_PREFIX = 0
+DEFAULT_MTR_QUEUE_SIZE = 1000
+DEFAULT_MTR_ENGINE = 'external'
+DEFAULT_MTR_MAX_HOPS = 30
+DEFAULT_MTR_PROBES = 3
+DEFAULT_MTR_NATIVE_WORKERS = 128
+DEFAULT_SCHEDULE_INTERVAL = 10
+DEFAULT_SCHEDULE_JITTER = 0.1
+DEFAULT_SCHEDULE_RELOAD = 5
+DEFAULT_METRICS_BIND = '127.0.0.1'
+DEFAULT_METRICS_SNAPSHOT_INTERVAL = 10
+METRICS_SHARD_INTERVAL = 5
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RTT_CSV_HEADERS = ['Min', 'Avg', 'Max', 'Stddev', 'Jitter', 'P50', 'P90', 'P99']
+RECORD_CSV_HEADERS = ['Time', 'IP', 'Sent', 'Rcvd', 'Loss'] + RTT_CSV_HEADERS + ['Hist', 'SchedDelay', 'Policy']
+SUM_CSV_HEADERS = ['IP', 'Sent', 'Rcvd', 'Loss'] + RTT_CSV_HEADERS
+HOP_CSV_HEADERS = ['Time', 'IP', 'Hop', 'Address', 'Sent', 'Rcvd', 'Loss', 'Min', 'Avg', 'Max', 'Stddev']
+RTT_HIST_MIN = 0.01
+RTT_HIST_GROWTH = 1.05
+RTT_HIST_BUCKETS = 340
+ICMP_HEADER = struct.Struct("!BBHHH")
+ICMP_TIMESTAMP = struct.Struct("!d")
+ICMP_TIMESTAMP_WORDS = struct.Struct("!HHHH")
+IPV4_ADDRESS = struct.Struct("!I")
+# Linux的SO_ATTACH_FILTER，socket模块中没有该常量
+SO_ATTACH_FILTER = 26
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+KERNEL_TIMESPEC = struct.Struct("@qq")
+# 二进制记录：时间(纳秒)、IPv4(域名为名字表序号)、Sent、Rcvd、策略、RTT_CSV_HEADERS各项(毫秒，无样本为NaN)、SchedDelay
+STORE_ROW = struct.Struct("<qIHHB3x9f")
+STORE_KEY = struct.Struct("<qI")
+# 段索引头：魔数、版本、最早时间、最晚时间、行数、目标数，后跟排序后的目标数组和每个目标的起始行号
+STORE_INDEX_HEADER = struct.Struct("<4sIqqII")
+STORE_INDEX_MAGIC = b'CIPX'
+STORE_POLICIES = ['', 'full', 'healthy', 'healthy+escalated', 'lossy']
+# Linux的SO_RXQ_OVFL：recvmsg的辅助数据中带上socket因接收缓冲区满而丢弃的报文数
+SO_RXQ_OVFL = 40
+RXQ_OVFL_COUNT = struct.Struct("@I")
+BPF_INSTRUCTION = struct.Struct("=HBBI")
+BPF_PROGRAM = struct.Struct("HP")
 
 
 def signal_handler(signum, frame):
-    cprint("red", "接收到Ctrl+C，等待线程退出.. %d" % signum)
-    if summary:
-        cprint("blue", "开始汇总数据: ")
-        CheckIp(record_dir=record_dir).sum_check_result()
-        cprint("blue", "汇总数据完成...")
+    """
+    第一次Ctrl+C：不再开始新的探测，主线程等待在途探测和写盘在shutdown_timeout内完成后正常汇总退出
+    第二次Ctrl+C：立即退出，己写盘的记录可用--resume继续
+    """
+    if shutdown_requested():
+        cprint("red", "再次接收到Ctrl+C，立即退出，可使用--resume继续写入记录目录")
+        os._exit(1)
+    cprint("red", "接收到Ctrl+C，停止开始新的探测，等待在途任务完成.. %d" % signum)
+    request_shutdown(get_settings().shutdown_timeout)
+
+
+_shutdown = threading.Event()
+_shutdown_deadline = None
+
+
+def request_shutdown(timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+    """
+    通知各主线程不再开始新的探测，在途的探测最多再等待timeout秒
+    """
+    global _shutdown_deadline
+    if not _shutdown.is_set():
+        _shutdown_deadline = time.time() + timeout
+        _shutdown.set()
+
+
+def shutdown_requested():
+    return _shutdown.is_set()
 
-    cprint("dark_green", "所有数据在目录[%s]" % record_dir)
-    end_time = time.time()
-    cprint("blue", "耗时： %s秒 " % round((end_time - start_time), 3))
-    sys.exit(0)
+
+def shutdown_remaining():
+    """
+    :return: 距停止期限的秒数，未请求停止时为None
+    """
+    if _shutdown_deadline is None:
+        return None
+    return max(0.0, _shutdown_deadline - time.time())
 
 
 def run_path():
@@ -85,6 +188,7 @@ def run_path():
 
 
 DEFAULT_IP_FILE = os.path.join(run_path(), 'iplist')
+DEFAULT_CONFIG_FILE = os.path.join(run_path(), 'config')
 
 
 def cprint(color, message):
@@ -102,159 +206,2565 @@ def cprint(color, message):
     print('%s%s\033[0m' % (color, message))
 
 
-class Pinger(object):
-    def __init__(self, host, count=DEFAULT_COUNT, timeout=DEFAULT_TIMEOUT, wait=DEFAULT_WAIT):
+log = logging.getLogger('check_ip')
+
+
+def setup_logging(verbosity=0):
+    """
+    逐个IP的过程日志：默认不输出；-v 输出每个IP的完成情况，-vv 输出各步骤耗时
+    日志先放入队列，由单独的线程写到stdout，探测线程不会阻塞在输出上
+    :param verbosity: INT -v的个数
+    """
+    log.setLevel(logging.DEBUG if verbosity >= 2 else logging.INFO if verbosity == 1 else logging.WARNING)
+    log.propagate = False
+    if log.handlers:
+        return
+    log_queue = queue.Queue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+class Counter(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge(Counter):
+    __slots__ = ('func',)
+
+    def __init__(self, func=None):
         """
-        :param host:  IP地址或域名
-        :param count: ping次数
-        :param timeout: icmp超时，单位秒
-        :param wait: 每次ping的间隔，单位ms
+        :param func: 取值函数，指定时在采集时调用，否则使用set/inc/dec维护的值
         """
-        self.target_host = host
-        self.count = count
-        self.timeout = timeout
-        self.wait = wait
+        super(Gauge, self).__init__()
+        self.func = func
 
-    @staticmethod
-    def do_checksum(source_string):
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func is None:
+            return self.value
+        try:
+            return self.func()
+        except Exception:
+            return 0
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class MetricsRegistry(object):
+    def __init__(self):
         """
-        来自 ping.c 的 in_cksum（） 功能
-        正常情况下，将在字符串上充当一系列 16 位 int（主机包装），但是网络数据是big-endian，主机一般是 little-endian
-        :param source_string:
-        :return:
+        进程内的指标：计数器、仪表和直方图，采集时输出Prometheus文本格式或JSON快照
+        多进程模式下子进程定期把快照交给父进程，父进程输出时带上shard标签
         """
-        sums = 0
-        max_count = (len(source_string) / 2) * 2
-        count = 0
-        # 成对处理字节(解码为短ints)
-        while count < max_count:
-            val = source_string[count + 1] * 256 + source_string[count]
-            sums = sums + val
-            sums = sums & 0xffffffff
-            count = count + 2
+        self._metrics = {}
+        self._remote = {}
+        self._lock = threading.Lock()
 
-        # 处理最后一个字节(奇数字节)
-        # 在这种情况下，Endianness应该是无关紧要的
-        if max_count < len(source_string):
-            sums = sums + ord(source_string[len(source_string) - 1])
-            # 将sum截断为32位(与ping.c不同)，它使用带符号的int，但是ping中不太可能出现溢出。
-            sums = sums & 0xffffffff
-        # 添加高位16bit到低位16bit
-        sums = (sums >> 16) + (sums & 0xffff)
-        # 如果存在，从上面结果中添加
-        sums = sums + (sums >> 16)
-        # 反转和截断到16位
-        answer = ~sums & 0xffff
-        answer = answer >> 8 | (answer << 8 & 0xff00)
-        return answer
+    def _register(self, name, kind, help_text, metric):
+        self._metrics[name] = (kind, help_text, metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(name, 'counter', help_text, Counter())
+
+    def gauge(self, name, help_text, func=None):
+        return self._register(name, 'gauge', help_text, Gauge(func))
+
+    def histogram(self, name, help_text, bounds=LATENCY_BUCKETS):
+        return self._register(name, 'histogram', help_text, Histogram(bounds))
+
+    def snapshot(self):
+        """
+        :return: DICT 名称 -> 当前值，直方图为 {bounds, counts, sum, count}
+        """
+        values = {}
+        for name, (kind, help_text, metric) in self._metrics.items():
+            if kind == 'histogram':
+                with metric._lock:
+                    values[name] = {'bounds': metric.bounds, 'counts': list(metric.counts),
+                                    'sum': metric.sum, 'count': metric.count}
+            elif kind == 'gauge':
+                values[name] = metric.get()
+            else:
+                values[name] = metric.value
+        return values
+
+    def merge_remote(self, shard, snapshot):
+        with self._lock:
+            self._remote[shard] = snapshot
 
     @staticmethod
-    def receive_icmp(sock, id, timeout):
+    def _samples(name, value, labels):
+        if not isinstance(value, dict):
+            return ['%s%s %s' % (name, '{%s}' % labels if labels else '', value)]
+        lines = []
+        cumulative = 0
+        prefix = labels + ',' if labels else ''
+        for bound, count in zip(value['bounds'] + ['+Inf'], value['counts']):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, cumulative))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, suffix, value['sum']))
+        lines.append('%s_count%s %d' % (name, suffix, value['count']))
+        return lines
+
+    def render(self):
         """
-        从socket 接收 ping
+        :return: STR Prometheus文本格式
         """
-        # 等待数据包返回或循环超时
-        while True:
-            time_remaining = timeout
-            start_t = time.time()
-            readable = select.select([sock], [], [], time_remaining)
-            time_spent = (time.time() - start_t)
-            # Timeout
-            if not readable[0]:
-                return
-            time_received = time.time()
-            recv_packet, addr = sock.recvfrom(1024)
-            icmp_header = recv_packet[20:28]
-            type, code, checksum, packet_id, sequence = struct.unpack("bbHHh", icmp_header)
-            if packet_id == id:
-                bytes_In_double = struct.calcsize("d")
-                time_sent = struct.unpack("d", recv_packet[28:28 + bytes_In_double])[0]
-                return time_received - time_sent
-            time_remaining = time_remaining - time_spent
-            if time_remaining <= 0:
-                return
+        local = self.snapshot()
+        with self._lock:
+            remote = sorted(self._remote.items())
+        lines = []
+        for name, (kind, help_text, metric) in self._metrics.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(self._samples(name, local[name], ''))
+            for shard, snapshot in remote:
+                if name in snapshot:
+                    lines.extend(self._samples(name, snapshot[name], 'shard="%s"' % shard))
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, path):
+        with self._lock:
+            remote = dict(self._remote)
+        data = {'time': time.time(), 'metrics': self.snapshot(), 'shards': remote}
+        with open(path + '.tmp', 'w') as f_snapshot:
+            json.dump(data, f_snapshot)
+        os.replace(path + '.tmp', path)
+
+
+metrics = MetricsRegistry()
+PROBES_SENT = metrics.counter('check_ip_probes_sent_total', 'ICMP probes sent')
+PROBES_RECEIVED = metrics.counter('check_ip_probes_received_total', 'Echo replies matched to a probe')
+ICMP_ERRORS_RECEIVED = metrics.counter('check_ip_icmp_errors_received_total', 'ICMP errors matched to a trace probe')
+PACKETS_IGNORED = metrics.counter('check_ip_packets_ignored_total', 'ICMP packets read but not matched to any probe')
+SOCKET_DROPS = metrics.gauge('check_ip_socket_drops_total', 'Packets dropped by the kernel because the socket buffer was full')
+PROBES_IN_FLIGHT = metrics.gauge('check_ip_probes_in_flight', 'Probes waiting for a reply')
+RTT_SECONDS = metrics.histogram('check_ip_rtt_seconds', 'Echo round trip time')
+RECEIVE_DELAY_SECONDS = metrics.histogram('check_ip_receive_delay_seconds',
+                                          'Delay between kernel receive and userspace read, removed from RTT')
+PING_CHECK_SECONDS = metrics.histogram('check_ip_ping_check_seconds', 'Duration of one ping check')
+SCHEDULER_LAG_SECONDS = metrics.histogram('check_ip_scheduler_lag_seconds', 'Delay between a target being due and dispatched')
+SCHEDULER_OVERDUE = metrics.counter('check_ip_scheduler_overdue_total', 'Due targets skipped because the previous check was still running')
+TARGETS_RUNNING = metrics.gauge('check_ip_targets_running', 'Targets dispatched by the scheduler and not finished')
+WRITER_QUEUE_DEPTH = metrics.gauge('check_ip_writer_queue_depth', 'Records waiting in result writer queues')
+WRITER_FLUSH_SECONDS = metrics.histogram('check_ip_writer_flush_seconds', 'Duration of one result writer flush')
+WRITER_ROWS = metrics.counter('check_ip_writer_rows_total', 'Ping records written')
+CHECKPOINT_SECONDS = metrics.histogram('check_ip_checkpoint_seconds', 'Duration of writing one checkpoint')
+MTR_QUEUE_DEPTH = metrics.gauge('check_ip_mtr_queue_depth', 'Traces waiting in mtr queues')
+MTR_QUEUE_WAIT_SECONDS = metrics.histogram('check_ip_mtr_queue_wait_seconds', 'Time a trace waited in the mtr queue')
+MTR_SECONDS = metrics.histogram('check_ip_mtr_seconds', 'Duration of one mtr or native trace')
+MTR_DROPPED = metrics.counter('check_ip_mtr_dropped_total', 'Traces dropped because the mtr queue was full')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-    def send_icmp(self, sock, check_id):
+
+def start_metrics(settings, record_dir=None):
+    """
+    按[metrics]配置启动HTTP采集端口和定期快照文件record_dir/metrics.json
+    """
+    if settings.metrics_port > 0:
+        try:
+            server = http.server.ThreadingHTTPServer((settings.metrics_bind, settings.metrics_port), MetricsHandler)
+            server.daemon_threads = True
+            t = threading.Thread(target=server.serve_forever, name='metrics-http')
+            t.daemon = True
+            t.start()
+            cprint("blue", "指标采集地址: http://%s:%d/metrics" % (settings.metrics_bind, settings.metrics_port))
+        except OSError as me:
+            cprint("red", "无法启动指标采集端口: %s" % str(me))
+    if record_dir and settings.metrics_snapshot_interval > 0:
+        def snapshot_loop():
+            path = os.path.join(record_dir, 'metrics.json')
+            while True:
+                time.sleep(settings.metrics_snapshot_interval)
+                try:
+                    metrics.write_snapshot(path)
+                except OSError as se:
+                    cprint("red", "metrics: %s" % str(se))
+
+        t = threading.Thread(target=snapshot_loop, name='metrics-snapshot')
+        t.daemon = True
+        t.start()
+
+
+Settings = namedtuple('Settings', [
+    'count', 'wait', 'timeout', 'pipeline', 'packet_size',
+    'adaptive', 'adaptive_healthy_rounds', 'adaptive_healthy_count', 'adaptive_lossy_count',
+    'mtr_path', 'mtr_paras', 'mtr_workers', 'mtr_timeout', 'mtr_cooldown', 'mtr_collapse_prefix', 'mtr_queue_size',
+    'mtr_engine', 'mtr_max_hops', 'mtr_probes', 'mtr_native_workers',
+    'dns_ttl', 'dns_negative_ttl',
+    'record_batch_size', 'record_flush_interval', 'record_format', 'record_segment_rows', 'record_checkpoint_interval',
+    'shutdown_timeout',
+    'schedule_continuous', 'schedule_interval', 'schedule_jitter',
+    'metrics_port', 'metrics_bind', 'metrics_snapshot_interval',
+])
+
+
+def load_settings(config_file=DEFAULT_CONFIG_FILE):
+    """
+    解析config为不可变的Settings
+    :raise configparser.Error, ValueError: 配置缺失或取值错误
+    """
+    c = configparser.ConfigParser()
+    with open(config_file, 'r') as f_config:
+        c.read_file(f_config)
+    return Settings(
+        count=c.getint('ping', 'count'),
+        wait=c.getint('ping', 'wait'),
+        timeout=c.getint('ping', 'timeout'),
+        pipeline=c.getboolean('ping', 'pipeline', fallback=False),
+        packet_size=c.getint('ping', 'size', fallback=DEFAULT_PACKET_SIZE),
+        adaptive=c.getboolean('ping', 'adaptive', fallback=False),
+        adaptive_healthy_rounds=c.getint('ping', 'healthy_rounds', fallback=DEFAULT_ADAPTIVE_HEALTHY_ROUNDS),
+        adaptive_healthy_count=c.getint('ping', 'healthy_count', fallback=DEFAULT_ADAPTIVE_HEALTHY_COUNT),
+        adaptive_lossy_count=c.getint('ping', 'lossy_count', fallback=DEFAULT_ADAPTIVE_LOSSY_COUNT),
+        mtr_path=c.get('mtr', 'path'),
+        mtr_paras=c.get('mtr', 'paras'),
+        mtr_workers=c.getint('mtr', 'workers', fallback=DEFAULT_MTR_WORKERS),
+        mtr_timeout=c.getint('mtr', 'timeout', fallback=DEFAULT_MTR_TIMEOUT),
+        mtr_cooldown=c.getint('mtr', 'cooldown', fallback=DEFAULT_MTR_COOLDOWN),
+        mtr_collapse_prefix=c.getint('mtr', 'collapse_prefix', fallback=DEFAULT_MTR_COLLAPSE_PREFIX),
+        mtr_queue_size=c.getint('mtr', 'queue_size', fallback=DEFAULT_MTR_QUEUE_SIZE),
+        mtr_engine=c.get('mtr', 'engine', fallback=DEFAULT_MTR_ENGINE).strip().lower(),
+        mtr_max_hops=c.getint('mtr', 'max_hops', fallback=DEFAULT_MTR_MAX_HOPS),
+        mtr_probes=c.getint('mtr', 'probes', fallback=DEFAULT_MTR_PROBES),
+        mtr_native_workers=c.getint('mtr', 'native_workers', fallback=DEFAULT_MTR_NATIVE_WORKERS),
+        dns_ttl=c.getint('dns', 'ttl', fallback=DEFAULT_DNS_TTL),
+        dns_negative_ttl=c.getint('dns', 'negative_ttl', fallback=DEFAULT_DNS_NEGATIVE_TTL),
+        record_batch_size=c.getint('record', 'batch_size', fallback=DEFAULT_RECORD_BATCH_SIZE),
+        record_flush_interval=c.getfloat('record', 'flush_interval', fallback=DEFAULT_RECORD_FLUSH_INTERVAL),
+        record_format=c.get('record', 'format', fallback=DEFAULT_RECORD_FORMAT).strip().lower(),
+        record_segment_rows=c.getint('record', 'segment_rows', fallback=DEFAULT_RECORD_SEGMENT_ROWS),
+        record_checkpoint_interval=c.getfloat('record', 'checkpoint_interval',
+                                              fallback=DEFAULT_RECORD_CHECKPOINT_INTERVAL),
+        shutdown_timeout=c.getfloat('record', 'shutdown_timeout', fallback=DEFAULT_SHUTDOWN_TIMEOUT),
+        schedule_continuous=c.getboolean('schedule', 'continuous', fallback=False),
+        schedule_interval=c.getfloat('schedule', 'interval', fallback=DEFAULT_SCHEDULE_INTERVAL),
+        schedule_jitter=c.getfloat('schedule', 'jitter', fallback=DEFAULT_SCHEDULE_JITTER),
+        metrics_port=c.getint('metrics', 'port', fallback=0),
+        metrics_bind=c.get('metrics', 'bind', fallback=DEFAULT_METRICS_BIND).strip(),
+        metrics_snapshot_interval=c.getfloat('metrics', 'snapshot_interval', fallback=DEFAULT_METRICS_SNAPSHOT_INTERVAL),
+    )
+
+
+class SettingsWatcher(object):
+    def __init__(self, config_file=DEFAULT_CONFIG_FILE):
         """
-        :param sock: socket icmp instance
-        :param check_id:
-        :return:
+        启动时解析一次config，之后只比较mtime，文件变化时在两轮检测之间整体替换Settings
+        :param config_file: 配置文件路径
         """
-        # 获取主机名，如果是域名会解析成IP
-        target_addr = socket.gethostbyname(self.target_host)
-        my_checksum = 0
-        # 生成校验和为0的报文heder。
-        header = struct.pack("bbHHh", ICMP_ECHO_REQUEST, 0, my_checksum, check_id, 1)
-
-        bytes_In_double = struct.calcsize("d")
-        data = (192 - bytes_In_double) * "Q"
-        data = struct.pack("d", time.time()) + bytes(data.encode('utf-8'))
-        # 计算报头和数据的校验和
-        my_checksum = self.do_checksum(header + data)
-        # 正确的校验和
-        header = struct.pack(
-            "bbHHh", ICMP_ECHO_REQUEST, 0, socket.htons(my_checksum), check_id, 1
-        )
-        # 计算并生成报头和数据的校验和
-        packet = header + data
-        # 端口号与ICMP无关
-        sock.sendto(packet, (target_addr, 1))
+        self.config_file = config_file
+        self.mtime = os.stat(config_file).st_mtime
+        self.settings = load_settings(config_file)
 
-    def ping_once(self):
-        icmp = socket.getprotobyname("icmp")
+    def refresh(self):
+        """
+        :return: 当前生效的Settings；新配置解析失败时继续使用旧配置
+        """
         try:
-            sock_fun = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
-        except socket.error as se:
-            if se.errno == 1:
-                se.msg += "Socket ICMP报文只能通过超级管理用户进程发送"
-                raise socket.error(se.msg)
-        except Exception as Ee:
-            cprint("red", "ping_once: %s" % str(Ee))
+            mtime = os.stat(self.config_file).st_mtime
+            if mtime == self.mtime:
+                return self.settings
+            settings = load_settings(self.config_file)
+            # 解析过程中文件又被修改，说明可能读到了写了一半的配置，下次再加载
+            if os.stat(self.config_file).st_mtime != mtime:
+                return self.settings
+            self.mtime = mtime
+            if settings != self.settings:
+                cprint("green", "config配置己变更，重新加载: %s" % self.config_file)
+                self.settings = settings
+                get_dns_cache().apply_settings(settings)
+        except (configparser.Error, ValueError, OSError) as ce:
+            cprint("red", "config配置文件重新加载失败，继续使用原配置：%s" % str(ce))
+        return self.settings
+
+
+_settings_watcher = None
+
+
+def get_settings_watcher():
+    """
+    :return: 进程内共享的SettingsWatcher，首次调用时加载config，配置有误则退出
+    """
+    global _settings_watcher
+    if _settings_watcher is None:
+        try:
+            _settings_watcher = SettingsWatcher(DEFAULT_CONFIG_FILE)
+        except (configparser.Error, ValueError) as ce:
+            cprint("red", "config配置文件中配置参数存在错误：")
+            print(str(ce))
             print(traceback.format_exc())
-        get_id = os.getpid() & 0xFFFF
-        self.send_icmp(sock_fun, get_id)
-        delay = self.receive_icmp(sock_fun, get_id, self.timeout)
-        return delay
+            sys.exit(1)
+    return _settings_watcher
+
+
+def get_settings():
+    """
+    :return: 当前生效的Settings
+    """
+    return get_settings_watcher().settings
+
+
+class ProbeWaiter(object):
+    """
+    单次探测的等待对象，由IcmpEngine的接收线程写入结果
+    """
+    __slots__ = ('ident', 'sequence', 'delay', 'adjust', 'addr', 'icmp_type', 'sent_at', 'trace', '_event')
+
+    def __init__(self, ident, sequence):
+        self.ident = ident
+        self.sequence = sequence
+        self.delay = None
+        # 内核收包时间戳与接收线程实际读到回包之间的差值，已从delay中扣除，单位秒
+        self.adjust = 0.0
+        self.addr = None
+        self.icmp_type = None
+        self.sent_at = None
+        # 路径追踪的探测才接收Time Exceeded等差错报文，ping只认Echo Reply
+        self.trace = False
+        self._event = threading.Event()
+
+    @property
+    def key(self):
+        return self.ident, self.sequence
+
+    def set(self, delay, addr=None, icmp_type=ICMP_ECHO_REPLY, adjust=0.0):
+        """
+        :param addr: 回包来源地址，仅ICMP差错报文(Time Exceeded等)时填写
+        :param icmp_type: 回包类型
+        :param adjust: 使用内核时间戳后扣除的调度延迟，单位秒
+        """
+        self.adjust = adjust
+        self.addr = addr
+        self.icmp_type = icmp_type
+        self.delay = delay
+        self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        return self.delay
+
+
+class AsyncProbeWaiter(ProbeWaiter):
+    """
+    asyncio模式下的等待对象，结果通过Future交给协程
+    """
+    __slots__ = ('_future',)
+
+    def __init__(self, ident, sequence):
+        super(AsyncProbeWaiter, self).__init__(ident, sequence)
+        self._future = asyncio.get_event_loop().create_future()
+
+    def set(self, delay, addr=None, icmp_type=ICMP_ECHO_REPLY, adjust=0.0):
+        self.adjust = adjust
+        self.addr = addr
+        self.icmp_type = icmp_type
+        self.delay = delay
+        # 事件循环己结束时不再通知协程
+        if not self._future.done() and not self._future.get_loop().is_closed():
+            self._future.set_result(delay)
+
+    async def wait(self, timeout):
+        await asyncio.wait([self._future], timeout=timeout)
+        return self.delay
+
+
+class IcmpEngine(object):
+    def __init__(self, ident_base=None, ident_count=DEFAULT_IDENT_COUNT, loop=None, sock=None):
+        """
+        所有探测共享的ICMP引擎：只持有一个raw socket，由一个接收线程按(标识符, 序列号)把回包分发给等待者
+        :param ident_base: 起始标识符，默认取进程号
+        :param ident_count: 可用标识符个数，每个标识符提供65536个序列号
+        :param loop: asyncio事件循环，指定时socket设为非阻塞，由事件循环通知可读，不再启动接收线程
+        :param sock: 指定时不再打开ICMP socket，按raw socket(报文含IP头)使用该对象，用于基准测试中的模拟应答
+        """
+        self.ident_base = (os.getpid() if ident_base is None else ident_base) & 0xFFFF
+        self.ident_count = max(1, min(ident_count, 0x10000))
+        self._key_space = self.ident_count << 16
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._waiters = {}
+        # 接收缓冲区只由接收线程(或事件循环)使用，recv_into复用同一块内存
+        self._recv_buf = bytearray(2048)
+        self._recv_view = memoryview(self._recv_buf)
+        self._closed = False
+        self._loop = loop
+        self.sock, self.raw = self._open_socket() if sock is None else (sock, True)
+        if self.raw:
+            self._attach_filter()
+        else:
+            # ping socket由内核改写标识符并只投递本socket的回包，只有一个标识符可用，且收不到差错报文
+            self.ident_base = self.sock.getsockname()[1] & 0xFFFF
+            self.ident_count = 1
+            self._key_space = 1 << 16
+        self.kernel_timestamps = self._enable_timestamps()
+        self._send_lock = threading.Lock()
+        self.default_ttl = self.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
+        self._ttl = self.default_ttl
+        if loop is None:
+            self._reader = threading.Thread(target=self._receive_loop, name='icmp-receiver')
+            self._reader.daemon = True
+            self._reader.start()
+        else:
+            self.sock.setblocking(False)
+            loop.add_reader(self.sock.fileno(), self._drain)
+
+    @property
+    def can_trace(self):
+        """
+        只有raw socket能收到差错报文，内置路径追踪依赖它
+        """
+        return self.raw
 
     @staticmethod
-    def get_loss(sent, rcvd):
-        if sent > 0:
-            loss = ((sent - rcvd) / sent) * 100.0
-            return loss
+    def _open_socket():
+        """
+        优先使用raw socket；没有权限时退回到非特权的ping socket(SOCK_DGRAM)，
+        需要net.ipv4.ping_group_range包含当前用户组
+        :return: TUPLE (socket, 是否为raw socket)
+        """
+        icmp = socket.getprotobyname("icmp")
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp), True
+        except socket.error as se:
+            if se.errno != 1:
+                raise
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, icmp)
+                sock.bind(('', 0))
+                cprint("blue", "没有raw socket权限，使用ping socket(SOCK_DGRAM)发送ICMP报文")
+                return sock, False
+            except socket.error:
+                raise socket.error("%s Socket ICMP报文只能通过超级管理用户进程发送" % se)
 
-    def ping(self):
-        sent = 0
-        rcvd = 0
-        status = "Success"
-        for i in range(self.count):
+    def _enable_timestamps(self):
+        """
+        打开SO_TIMESTAMPNS，通过recvmsg的辅助数据取得内核收包时间，不支持时使用读到回包时的时间
+        """
+        if not hasattr(self.sock, 'recvmsg_into') or not sys.platform.startswith('linux'):
+            return False
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self._ancillary_size = socket.CMSG_SPACE(KERNEL_TIMESPEC.size)
             try:
-                sent += 1
-                # unit: Second
-                delay = self.ping_once()
-            except socket.gaierror as ge:
-                status = "Error"
-                print("Ping failed. (socket error: '%s')" % str(ge))
-                print(traceback.format_exc())
-                break
-            if delay is None:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._ancillary_size += socket.CMSG_SPACE(RXQ_OVFL_COUNT.size)
+            except OSError:
                 pass
-            else:
-                rcvd += 1
-                time.sleep(self.wait / 1000)
-        if rcvd == 0:
-            status = "Failed"
-        rtime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-        return dict({"Status": status, "Time": rtime, "Sent": sent, "Rcvd": rcvd, "Loss": "{:.2f}%" .format(self.get_loss(sent, rcvd))})
+            return True
+        except OSError as te:
+            cprint("red", "IcmpEngine: 无法启用内核时间戳: %s" % str(te))
+            return False
+
+    def _recv(self):
+        """
+        读取一个报文到接收缓冲区
+        发送和接收时间都取自单调时钟，不受NTP调整影响；内核时间戳是系统时间，
+        只用它与当前系统时间的差值(报文在socket队列中等待、接收线程等待调度和GIL的时间)修正单调时钟的读数
+        :return: TUPLE (报文长度, 收包时间(单调时钟), 扣除的调度延迟)
+        """
+        if not self.kernel_timestamps:
+            nbytes = self.sock.recv_into(self._recv_buf)
+            return nbytes, time.monotonic(), 0.0
+        nbytes, ancdata, flags, addr = self.sock.recvmsg_into([self._recv_buf], self._ancillary_size)
+        time_received = time.monotonic()
+        now = time.time()
+        adjust = 0.0
+        for level, cmsg_type, cmsg_data in ancdata:
+            if level != socket.SOL_SOCKET:
+                continue
+            if cmsg_type == SO_TIMESTAMPNS and len(cmsg_data) >= KERNEL_TIMESPEC.size:
+                sec, nsec = KERNEL_TIMESPEC.unpack_from(cmsg_data)
+                adjust = min(max(now - (sec + nsec / 1e9), 0.0), 1.0)
+            elif cmsg_type == SO_RXQ_OVFL and len(cmsg_data) >= RXQ_OVFL_COUNT.size:
+                # 内核给出的是累计值
+                SOCKET_DROPS.set(RXQ_OVFL_COUNT.unpack_from(cmsg_data)[0])
+        return nbytes, time_received - adjust, adjust
+
+    def bpf_program(self):
+        """
+        经典BPF过滤程序：内核只把标识符在本引擎范围内的Echo Reply，以及原始报文是本引擎Echo Request的
+        超时/不可达差错报文交给socket，其它进程、其它工具的ICMP报文不再唤醒接收线程
+        raw socket上报文从IP头开始；标识符范围可能跨过0xFFFF，按 (id - ident_base) & 0xFFFF < ident_count 判断
+        """
+        ld_b_ind, ld_h_ind, ldx_msh = 0x50, 0x48, 0xb1
+        alu_and, alu_lsh, alu_add_x, alu_sub = 0x54, 0x64, 0x0c, 0x14
+        jeq, jge, ja, tax, ret = 0x15, 0x35, 0x05, 0x07, 0x06
+        program = [
+            (ldx_msh, 0, 0, 0),                      # 0: X = 外层IP头长度
+            (ld_b_ind, 0, 0, 0),                     # 1: A = ICMP类型
+            (jeq, 11, 0, ICMP_ECHO_REPLY),           # 2: Echo Reply -> 14
+            (jeq, 1, 0, ICMP_TIME_EXCEEDED),         # 3: 超时 -> 5
+            (jeq, 0, 14, ICMP_DEST_UNREACH),         # 4: 不可达 -> 5，其它 -> 19
+            (ld_b_ind, 0, 0, 8),                     # 5: A = 内层IP头第一个字节
+            (alu_and, 0, 0, 0x0F),                   # 6
+            (alu_lsh, 0, 0, 2),                      # 7: A = 内层IP头长度
+            (alu_add_x, 0, 0, 0),                    # 8
+            (tax, 0, 0, 0),                          # 9: X = 外层IP头长度 + 内层IP头长度
+            (ld_b_ind, 0, 0, 8),                     # 10: A = 内层ICMP类型
+            (jeq, 0, 7, ICMP_ECHO_REQUEST),          # 11: 不是Echo Request -> 19
+            (ld_h_ind, 0, 0, 12),                    # 12: A = 内层标识符
+            (ja, 0, 0, 1),                           # 13: -> 15
+            (ld_h_ind, 0, 0, 4),                     # 14: A = 标识符
+            (alu_sub, 0, 0, self.ident_base),        # 15
+            (alu_and, 0, 0, 0xFFFF),                 # 16
+            (jge, 1, 0, self.ident_count),           # 17: 不在标识符范围内 -> 19
+            (ret, 0, 0, 0x40000),                    # 18: 接收
+            (ret, 0, 0, 0),                          # 19: 丢弃
+        ]
+        return b''.join(BPF_INSTRUCTION.pack(*instruction) for instruction in program), len(program)
+
+    def _attach_filter(self):
+        """
+        在raw socket上挂载BPF过滤程序，不支持时(非Linux等)仍由_dispatch在用户态过滤
+        """
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            instructions, length = self.bpf_program()
+            # 程序缓冲区必须在setsockopt期间保持有效，内核会复制一份
+            self._bpf_buffer = ctypes.create_string_buffer(instructions)
+            fprog = BPF_PROGRAM.pack(length, ctypes.addressof(self._bpf_buffer))
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        except (OSError, ValueError) as fe:
+            cprint("red", "IcmpEngine: 挂载BPF过滤失败，在用户态过滤回包: %s" % str(fe))
+
+    def register(self, waiter_class=ProbeWaiter, trace=False):
+        """
+        分配一个未被占用的(标识符, 序列号)，并登记等待者
+        :param waiter_class: ProbeWaiter或AsyncProbeWaiter
+        :param trace: 是否为路径追踪的探测，是则同时接收差错报文
+        :return: ProbeWaiter
+        """
+        with self._lock:
+            for _ in range(self._key_space):
+                n = self._next_key
+                self._next_key = (n + 1) % self._key_space
+                key = ((self.ident_base + (n >> 16)) & 0xFFFF, n & 0xFFFF)
+                if key not in self._waiters:
+                    waiter = waiter_class(*key)
+                    waiter.trace = trace
+                    self._waiters[key] = waiter
+                    return waiter
+        raise RuntimeError("IcmpEngine: 在途探测数超过标识符空间")
+
+    def unregister(self, waiter):
+        with self._lock:
+            self._waiters.pop(waiter.key, None)
+
+    def send(self, packet, addr, ttl=None):
+        """
+        :param packet: 完整的ICMP报文
+        :param addr: 目标IP
+        :param ttl: 指定IP TTL(路径追踪)，不指定时使用系统默认值
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._send_lock:
+            # socket是共享的，修改TTL和发送必须在同一把锁内完成
+            if ttl != self._ttl:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                self._ttl = ttl
+            # 端口号与ICMP无关
+            self.sock.sendto(packet, (addr, 1))
+        PROBES_SENT.inc()
+
+    def detach_loop(self):
+        """
+        事件循环结束前调用(须在事件循环所在线程中)：改由接收线程读取回包，
+        之后仍在mtr调度队列中的内置路径追踪照常收到回包
+        """
+        if self._loop is None or self._closed:
+            return
+        self._loop.remove_reader(self.sock.fileno())
+        self._loop = None
+        self.sock.setblocking(True)
+        self._reader = threading.Thread(target=self._receive_loop, name='icmp-receiver')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def close(self):
+        """
+        停止接收并关闭socket
+        """
+        self._closed = True
+        if self._loop is not None:
+            self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+    def _receive_loop(self):
+        while not self._closed:
+            try:
+                readable = select.select([self.sock], [], [], 1.0)
+                if not readable[0]:
+                    continue
+                nbytes, time_received, adjust = self._recv()
+                self._dispatch(self._recv_view, nbytes, time_received, adjust)
+            except Exception as ee:
+                if self._closed:
+                    return
+                cprint("red", "IcmpEngine: %s" % str(ee))
+                print(traceback.format_exc())
+                time.sleep(0.1)
+
+    def _drain(self):
+        """
+        asyncio模式下socket可读时调用，读完当前所有报文
+        """
+        while True:
+            try:
+                nbytes, time_received, adjust = self._recv()
+            except (BlockingIOError, InterruptedError):
+                return
+            self._dispatch(self._recv_view, nbytes, time_received, adjust)
+
+    def _dispatch(self, packet, nbytes, time_received, adjust=0.0):
+        """
+        :param packet: memoryview，包含IP头的接收报文，直接在其上解析，不做切片拷贝
+        :param nbytes: 报文实际长度
+        :param time_received: 收包时间，单调时钟
+        :param adjust: 已从收包时间中扣除的调度延迟
+        """
+        # ping socket收到的报文不含IP头
+        ip_header_len = (packet[0] & 0x0F) * 4 if self.raw else 0
+        if nbytes < ip_header_len + ICMP_HEADER.size:
+            return
+        type, code, checksum, packet_id, sequence = ICMP_HEADER.unpack_from(packet, ip_header_len)
+        if type == ICMP_ECHO_REPLY:
+            if nbytes < ip_header_len + ICMP_HEADER.size + ICMP_TIMESTAMP.size:
+                return
+            waiter = self._waiters.get((packet_id, sequence))
+            if waiter is None:
+                PACKETS_IGNORED.inc()
+                return
+            time_sent = ICMP_TIMESTAMP.unpack_from(packet, ip_header_len + ICMP_HEADER.size)[0]
+            waiter.set(time_received - time_sent, adjust=adjust)
+            PROBES_RECEIVED.inc()
+            RTT_SECONDS.observe(time_received - time_sent)
+            RECEIVE_DELAY_SECONDS.observe(adjust)
+        elif type in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACH):
+            # 差错报文携带原始IP头和原始ICMP头的前8字节，从中取出标识符和序列号
+            inner_offset = ip_header_len + ICMP_HEADER.size
+            if nbytes < inner_offset + 1:
+                return
+            inner_icmp = inner_offset + (packet[inner_offset] & 0x0F) * 4
+            if nbytes < inner_icmp + ICMP_HEADER.size:
+                return
+            inner_type, inner_code, inner_checksum, packet_id, sequence = ICMP_HEADER.unpack_from(packet, inner_icmp)
+            if inner_type != ICMP_ECHO_REQUEST:
+                return
+            waiter = self._waiters.get((packet_id, sequence))
+            if waiter is None or not waiter.trace:
+                PACKETS_IGNORED.inc()
+                return
+            delay = time_received - waiter.sent_at if waiter.sent_at is not None else 0.0
+            waiter.set(delay, socket.inet_ntoa(packet[12:16]), type, adjust)
+            ICMP_ERRORS_RECEIVED.inc()
+        else:
+            PACKETS_IGNORED.inc()
+
+
+class IcmpPacketTemplate(object):
+    def __init__(self, size=DEFAULT_PACKET_SIZE):
+        """
+        预先生成的Echo Request报文模板，每次探测只改写标识符、序列号和时间戳
+        校验和按RFC1624增量计算：模板中固定部分的和预先算好，只累加变化的字段
+        :param size: 数据部分长度(含8字节时间戳)，单位字节
+        """
+        self.size = max(size, ICMP_TIMESTAMP.size)
+        data = ICMP_TIMESTAMP.pack(0) + (self.size - ICMP_TIMESTAMP.size) * b"Q"
+        self.template = bytes(ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, 0, 0) + data)
+        self.base_sum = self.ones_sum(self.template)
+        self._local = threading.local()
+
+    @staticmethod
+    def ones_sum(source_bytes):
+        """
+        按网络字节序把报文视为16位整数序列求和(未折叠)
+        """
+        if len(source_bytes) % 2:
+            source_bytes = source_bytes + b"\x00"
+        return sum(struct.unpack("!%dH" % (len(source_bytes) // 2), source_bytes))
+
+    def buffer(self):
+        """
+        :return: 当前线程专用的发送缓冲区，首次使用时从模板拷贝
+        """
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self.template)
+        return buf
+
+    def build(self, ident, sequence, timestamp):
+        """
+        :return: bytearray 填好字段和校验和的报文，缓冲区在同一线程内复用，发送后即可被覆盖
+        """
+        buf = self.buffer()
+        ICMP_HEADER.pack_into(buf, 0, ICMP_ECHO_REQUEST, 0, 0, ident, sequence)
+        ICMP_TIMESTAMP.pack_into(buf, ICMP_HEADER.size, timestamp)
+        t0, t1, t2, t3 = ICMP_TIMESTAMP_WORDS.unpack_from(buf, ICMP_HEADER.size)
+        sums = self.base_sum + ident + sequence + t0 + t1 + t2 + t3
+        sums = (sums >> 16) + (sums & 0xffff)
+        sums = sums + (sums >> 16)
+        struct.pack_into("!H", buf, 2, ~sums & 0xffff)
+        return buf
+
+
+_packet_templates = {}
+
+
+def get_packet_template(size=DEFAULT_PACKET_SIZE):
+    """
+    :return: 按数据长度缓存的IcmpPacketTemplate
+    """
+    template = _packet_templates.get(size)
+    if template is None:
+        template = _packet_templates.setdefault(size, IcmpPacketTemplate(size))
+    return template
+
+
+class DnsEntry(object):
+    __slots__ = ('addr', 'error', 'expires', 'used')
+
+    def __init__(self, addr, error, expires):
+        self.addr = addr
+        self.error = error
+        self.expires = expires
+        self.used = time.time()
+
+
+class DnsCache(object):
+    def __init__(self, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL, workers=16):
+        """
+        目标域名解析缓存：启动时并发预解析，之后由后台线程在过期前刷新，探测路径上不再调用解析器
+        :param ttl: 解析成功的缓存时间，单位秒
+        :param negative_ttl: 解析失败的缓存时间，单位秒
+        :param workers: 并发解析的线程数
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self._entries = {}
+        self._refreshing = set()
+        self._targets = frozenset()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._refresher = None
+
+    @staticmethod
+    def is_ip_literal(host):
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dns')
+            return self._executor
+
+    def resolve(self, host):
+        """
+        调用系统解析器解析并写入缓存(含失败结果)
+        :return: DnsEntry
+        """
+        try:
+            entry = DnsEntry(socket.gethostbyname(host), None, time.time() + self.ttl)
+        except socket.gaierror as ge:
+            entry = DnsEntry(None, ge, time.time() + self.negative_ttl)
+        with self._lock:
+            old = self._entries.get(host)
+            if old is not None:
+                entry.used = old.used
+            self._entries[host] = entry
+            self._refreshing.discard(host)
+        return entry
+
+    def apply_settings(self, settings):
+        self.ttl = settings.dns_ttl
+        self.negative_ttl = settings.dns_negative_ttl
+
+    def lookup(self, host):
+        """
+        :return: 缓存中的IP地址；IP直接返回
+        :raise socket.gaierror: 域名解析失败(负缓存)；未缓存的域名交给后台解析，本次探测按解析失败处理，
+                                探测路径上(包括asyncio事件循环中)不会阻塞在解析器上
+        """
+        if self.is_ip_literal(host):
+            return host
+        entry = self._entries.get(host)
+        if entry is None:
+            with self._lock:
+                submit = host not in self._refreshing
+                self._refreshing.add(host)
+            if submit:
+                self._pool().submit(self.resolve, host)
+            self.start_refresher()
+            raise socket.gaierror(socket.EAI_AGAIN, "域名[%s]尚未解析，己交给后台解析" % host)
+        entry.used = time.time()
+        if entry.addr is None:
+            raise entry.error
+        return entry.addr
+
+    def prefetch(self, hosts):
+        """
+        并发解析尚未缓存的域名，并启动后台刷新线程；hosts是当前的全部目标，其中的域名即使长时间未被探测也不会被清理
+        """
+        hosts = frozenset(host for host in hosts if not self.is_ip_literal(host))
+        self._targets = hosts
+        pending = [host for host in hosts if host not in self._entries]
+        if pending:
+            list(self._pool().map(self.resolve, pending))
+        self.start_refresher()
+
+    def start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name='dns-refresher')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(1)
+            try:
+                now = time.time()
+                expired = []
+                with self._lock:
+                    for host, entry in list(self._entries.items()):
+                        # 己不在目标列表中且长时间未被探测使用的域名不再刷新
+                        if host not in self._targets and now - entry.used > 2 * max(self.ttl, self.negative_ttl):
+                            del self._entries[host]
+                        elif entry.expires <= now and host not in self._refreshing:
+                            self._refreshing.add(host)
+                            expired.append(host)
+                # _pool()会获取同一把锁，必须在释放锁之后提交
+                for host in expired:
+                    self._pool().submit(self.resolve, host)
+            except Exception as re:
+                cprint("red", "DnsCache: %s" % str(re))
+                print(traceback.format_exc())
+
+
+_dns_cache = None
+_dns_cache_lock = threading.Lock()
+
+
+def get_dns_cache():
+    """
+    :return: 进程内共享的DnsCache，首次调用时按Settings中[dns]配置创建
+    """
+    global _dns_cache
+    if _dns_cache is None:
+        with _dns_cache_lock:
+            if _dns_cache is None:
+                settings = get_settings()
+                _dns_cache = DnsCache(ttl=settings.dns_ttl, negative_ttl=settings.dns_negative_ttl)
+    return _dns_cache
+
+
+_icmp_engine = None
+_icmp_engine_lock = threading.Lock()
+_icmp_ident_base = None
+_icmp_socket_factory = None
+
+
+def set_icmp_socket_factory(factory):
+    """
+    指定之后创建IcmpEngine时使用的socket，factory()返回的对象按raw socket使用，None恢复默认
+    """
+    global _icmp_socket_factory
+    _icmp_socket_factory = factory
+
+
+def reset_icmp_engine():
+    """
+    关闭进程内共享的IcmpEngine，下次使用时重新创建
+    """
+    global _icmp_engine
+    with _icmp_engine_lock:
+        engine, _icmp_engine = _icmp_engine, None
+    if engine is not None:
+        engine.close()
+
+
+def set_icmp_ident_base(ident_base):
+    """
+    多进程模式下为本进程指定起始标识符，各进程的标识符范围互不重叠，需在首次探测前调用
+    """
+    global _icmp_ident_base
+    _icmp_ident_base = ident_base
+
+
+def get_icmp_engine(loop=None):
+    """
+    :param loop: asyncio模式下传入事件循环，仅在首次创建时生效
+    :return: 进程内共享的IcmpEngine，首次调用时创建
+    """
+    global _icmp_engine
+    if _icmp_engine is None:
+        with _icmp_engine_lock:
+            if _icmp_engine is None:
+                sock = _icmp_socket_factory() if _icmp_socket_factory is not None else None
+                _icmp_engine = IcmpEngine(ident_base=_icmp_ident_base, loop=loop, sock=sock)
+    return _icmp_engine
+
+
+PROBES_IN_FLIGHT.func = lambda: len(_icmp_engine._waiters) if _icmp_engine is not None else 0
+
+
+def native_trace_available():
+    """
+    :return: BOOL 内置路径追踪是否可用，ping socket收不到差错报文时退回到外部mtr
+    """
+    engine = _icmp_engine
+    return engine is None or engine.can_trace
+
+
+class RttStats(object):
+    """
+    RTT统计(单位毫秒)：min/avg/max/stddev/jitter精确计算，分位数来自固定桶数的对数直方图
+    桶宽按1.05倍递增，相对误差约2.5%，覆盖0.01ms到60s，内存与样本数无关，可跨轮次、跨进程合并
+    """
+    __slots__ = ('count', 'min', 'max', 'sum', 'sumsq', 'jitter_sum', 'jitter_count', 'buckets')
+
+    LOG_GROWTH = math.log(RTT_HIST_GROWTH)
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.jitter_sum = 0.0
+        self.jitter_count = 0
+        self.buckets = {}
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value <= RTT_HIST_MIN:
+            return 0
+        return min(int(math.log(value / RTT_HIST_MIN) / cls.LOG_GROWTH) + 1, RTT_HIST_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_value(index):
+        if index == 0:
+            return RTT_HIST_MIN
+        return RTT_HIST_MIN * RTT_HIST_GROWTH ** (index - 0.5)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    @classmethod
+    def from_delays(cls, delays):
+        """
+        :param delays: 按发送顺序排列的延迟，单位秒，丢包为None；相邻两个回包的差值计入jitter
+        """
+        stats = cls()
+        last = None
+        for delay in delays:
+            if delay is None:
+                continue
+            value = delay * 1000
+            stats.add(value)
+            if last is not None:
+                stats.jitter_sum += abs(value - last)
+                stats.jitter_count += 1
+            last = value
+        return stats
+
+    def merge(self, other):
+        if other is None or not other.count:
+            return self
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.jitter_sum += other.jitter_sum
+        self.jitter_count += other.jitter_count
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        return self
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else None
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return None
+        avg = self.sum / self.count
+        return math.sqrt(max(self.sumsq / self.count - avg * avg, 0.0))
+
+    @property
+    def jitter(self):
+        return self.jitter_sum / self.jitter_count if self.jitter_count else None
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def fields(self):
+        """
+        :return: LIST 与RTT_CSV_HEADERS对应的文本，无样本时为空
+        """
+        return ['' if value is None else "{:.3f}".format(value) for value in self.values()]
+
+    def values(self):
+        """
+        :return: LIST 与RTT_CSV_HEADERS对应的数值，无样本时为None
+        """
+        return [self.min, self.avg, self.max, self.stddev, self.jitter,
+                self.quantile(0.5), self.quantile(0.9), self.quantile(0.99)]
+
+    def encode(self):
+        """
+        :return: 稀疏直方图文本 "桶号:个数;..."，用于写入记录文件后再合并
+        """
+        return ';'.join('%d:%d' % (index, self.buckets[index]) for index in sorted(self.buckets))
+
+    def state(self):
+        """
+        :return: LIST 完整的累计值(不含直方图)，用于写入检查点，与from_state对应
+        """
+        return [self.count, self.min, self.max, self.sum, self.sumsq, self.jitter_sum, self.jitter_count]
+
+    @classmethod
+    def from_state(cls, fields, hist):
+        """
+        由检查点中state()各项的文本和encode()的直方图还原，与写入时完全相同
+        """
+        stats = cls()
+        count, min_v, max_v, total, sumsq, jitter_sum, jitter_count = fields
+        stats.count = int(count)
+        stats.min = float(min_v) if min_v else None
+        stats.max = float(max_v) if max_v else None
+        stats.sum = float(total)
+        stats.sumsq = float(sumsq)
+        stats.jitter_sum = float(jitter_sum)
+        stats.jitter_count = int(jitter_count)
+        for item in hist.split(';') if hist else ():
+            index, n = item.split(':')
+            stats.buckets[int(index)] = int(n)
+        return stats
+
+    @classmethod
+    def from_record(cls, rcvd, fields, hist):
+        """
+        由记录文件中一行的Rcvd、RTT_CSV_HEADERS各列和Hist列还原统计，用于流式汇总
+        """
+        stats = cls()
+        if not rcvd or not fields[0]:
+            return stats
+        min_v, avg, max_v, stddev = (float(v) for v in fields[:4])
+        stats.count = rcvd
+        stats.min = min_v
+        stats.max = max_v
+        stats.sum = avg * rcvd
+        stats.sumsq = rcvd * (stddev * stddev + avg * avg)
+        if fields[4]:
+            stats.jitter_count = rcvd - 1
+            stats.jitter_sum = float(fields[4]) * stats.jitter_count
+        for item in hist.split(';') if hist else ():
+            index, n = item.split(':')
+            stats.buckets[int(index)] = int(n)
+        return stats
+
+
+class ProbePolicy(object):
+    def __init__(self):
+        """
+        自适应探测：按每个目标最近的结果决定本次发送的探测数
+            连续healthy_rounds次无丢包 -> healthy，只发healthy_count个，出现丢包时立即补发count个
+            上一次有丢包            -> lossy，发lossy_count个
+            其它(含首次)             -> full，发count个
+        历史只记一个整数：>=0为连续无丢包的次数，-1为上一次有丢包
+        """
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def decide(self, ip, settings):
+        """
+        :return: TUPLE (策略名, 探测数)
+        """
+        if not settings.adaptive:
+            return 'full', settings.count
+        state = self._history.get(ip)
+        if state is None:
+            return 'full', settings.count
+        if state < 0:
+            return 'lossy', max(settings.adaptive_lossy_count, settings.count)
+        if state >= settings.adaptive_healthy_rounds:
+            return 'healthy', max(1, min(settings.adaptive_healthy_count, settings.count))
+        return 'full', settings.count
+
+    def update(self, ip, sent, rcvd):
+        with self._lock:
+            if sent and rcvd == sent:
+                self._history[ip] = max(self._history.get(ip, 0), 0) + 1
+            else:
+                self._history[ip] = -1
+
+    def state(self):
+        """
+        :return: DICT 各目标的历史，用于写入检查点
+        """
+        with self._lock:
+            return dict(self._history)
+
+    def restore(self, history):
+        with self._lock:
+            self._history.update(history)
+
+
+_probe_policy = None
+_probe_policy_lock = threading.Lock()
+
+
+def get_probe_policy():
+    """
+    :return: 进程内共享的ProbePolicy
+    """
+    global _probe_policy
+    if _probe_policy is None:
+        with _probe_policy_lock:
+            if _probe_policy is None:
+                _probe_policy = ProbePolicy()
+    return _probe_policy
+
+
+class Pinger(object):
+    def __init__(self, host, count=DEFAULT_COUNT, timeout=DEFAULT_TIMEOUT, wait=DEFAULT_WAIT, pipeline=False,
+                 size=DEFAULT_PACKET_SIZE):
+        """
+        :param host:  IP地址或域名
+        :param count: ping次数
+        :param timeout: icmp超时，单位秒
+        :param wait: 每次ping的间隔，单位ms
+        :param pipeline: 流水线模式，按wait间隔连续发出所有探测，不等待上一个回包
+        :param size: ICMP数据部分长度，单位字节
+        """
+        self.target_host = host
+        self.count = count
+        self.timeout = timeout
+        self.wait = wait
+        self.pipeline = pipeline
+        self.size = size
+        self.adjusts = []
+
+    @classmethod
+    def from_settings(cls, host, settings, **kwargs):
+        """
+        :param settings: Settings，取其中[ping]部分的参数，kwargs中的同名参数优先
+        """
+        params = dict(count=settings.count, timeout=settings.timeout, wait=settings.wait,
+                      pipeline=settings.pipeline, size=settings.packet_size)
+        params.update(kwargs)
+        return cls(host, **params)
+
+    @staticmethod
+    def do_checksum(source_string):
+        """
+        来自 ping.c 的 in_cksum（） 功能
+        正常情况下，将在字符串上充当一系列 16 位 int（主机包装），但是网络数据是big-endian，主机一般是 little-endian
+        :param source_string:
+        :return:
+        """
+        sums = 0
+        max_count = (len(source_string) / 2) * 2
+        count = 0
+        # 成对处理字节(解码为短ints)
+        while count < max_count:
+            val = source_string[count + 1] * 256 + source_string[count]
+            sums = sums + val
+            sums = sums & 0xffffffff
+            count = count + 2
+
+        # 处理最后一个字节(奇数字节)
+        # 在这种情况下，Endianness应该是无关紧要的
+        if max_count < len(source_string):
+            sums = sums + ord(source_string[len(source_string) - 1])
+            # 将sum截断为32位(与ping.c不同)，它使用带符号的int，但是ping中不太可能出现溢出。
+            sums = sums & 0xffffffff
+        # 添加高位16bit到低位16bit
+        sums = (sums >> 16) + (sums & 0xffff)
+        # 如果存在，从上面结果中添加
+        sums = sums + (sums >> 16)
+        # 反转和截断到16位
+        answer = ~sums & 0xffff
+        answer = answer >> 8 | (answer << 8 & 0xff00)
+        return answer
+
+    def send_icmp(self, engine, check_id, sequence=1, ttl=None):
+        """
+        :param engine: IcmpEngine
+        :param check_id: ICMP报文标识符
+        :param sequence: ICMP报文序列号
+        :param ttl: IP TTL，默认使用系统值
+        :return:
+        """
+        # 获取主机名，如果是域名则从解析缓存中取IP
+        target_addr = get_dns_cache().lookup(self.target_host)
+        # 基于预生成的模板填写标识符、序列号、时间戳(单调时钟)，校验和增量计算
+        packet = get_packet_template(self.size).build(check_id, sequence, time.monotonic())
+        engine.send(packet, target_addr, ttl)
+
+    def ping_once(self):
+        """
+        通过共享的IcmpEngine发送一次探测，每次探测使用唯一的(标识符, 序列号)
+        :return: 延迟，单位秒；超时返回None
+        """
+        engine = get_icmp_engine()
+        waiter = engine.register()
+        try:
+            self.send_icmp(engine, waiter.ident, waiter.sequence)
+            return self.note_adjust(waiter, waiter.wait(self.timeout))
+        finally:
+            engine.unregister(waiter)
+
+    def note_adjust(self, waiter, delay):
+        """
+        记录收到回包的探测被扣除的调度延迟
+        :return: delay
+        """
+        if delay is not None:
+            self.adjusts.append(waiter.adjust)
+        return delay
+
+    @staticmethod
+    def get_loss(sent, rcvd):
+        if sent > 0:
+            loss = ((sent - rcvd) / sent) * 100.0
+            return loss
+
+    def ping(self):
+        if self.pipeline:
+            return self.ping_pipelined()
+        sent = 0
+        rcvd = 0
+        status = "Success"
+        delays = []
+        for i in range(self.count):
+            try:
+                sent += 1
+                # unit: Second
+                delay = self.ping_once()
+            except OSError as ge:
+                # 解析失败或发送失败(如EACCES、ENETUNREACH)都按探测失败处理
+                status = "Error"
+                log.warning("%s Ping failed. (socket error: '%s')", self.target_host, ge)
+                break
+            delays.append(delay)
+            if delay is None:
+                pass
+            else:
+                rcvd += 1
+                time.sleep(self.wait / 1000)
+        return self.ping_result(status, sent, rcvd, delays)
+
+    def ping_pipelined(self):
+        """
+        流水线模式：每隔wait毫秒发出一个探测(序列号各不相同)，回包到达即计数，最后一个探测超时后结束
+        耗时约为 count * wait + timeout，而不是 count * timeout
+        """
+        engine = get_icmp_engine()
+        sent = 0
+        rcvd = 0
+        status = "Success"
+        pending = []
+        delays = []
+        try:
+            for i in range(self.count):
+                if i:
+                    time.sleep(self.wait / 1000)
+                waiter = engine.register()
+                pending.append((waiter, time.time() + self.timeout))
+                try:
+                    sent += 1
+                    self.send_icmp(engine, waiter.ident, waiter.sequence)
+                except OSError as ge:
+                    status = "Error"
+                    log.warning("%s Ping failed. (socket error: '%s')", self.target_host, ge)
+                    break
+            for waiter, deadline in pending:
+                delays.append(self.note_adjust(waiter, waiter.wait(max(0, deadline - time.time()))))
+            rcvd = len([delay for delay in delays if delay is not None])
+        finally:
+            for waiter, deadline in pending:
+                engine.unregister(waiter)
+        return self.ping_result(status, sent, rcvd, delays)
+
+    def ping_result(self, status, sent, rcvd, delays=()):
+        """
+        :param delays: 按发送顺序排列的延迟，单位秒，丢包为None
+        :return: DICT 其中Stats为本轮的RttStats
+        """
+        if rcvd == 0:
+            status = "Failed"
+        timestamp = time.time_ns()
+        rtime = datetime.datetime.fromtimestamp(timestamp / 1e9).strftime('%Y-%m-%d %H:%M:%S.%f')
+        # SchedDelay: 每个回包平均扣除的调度延迟，单位毫秒
+        sched_delay = "%.3f" % (sum(self.adjusts) / len(self.adjusts) * 1000) if self.adjusts else ""
+        return dict({"Status": status, "Time": rtime, "Sent": sent, "Rcvd": rcvd, "Loss": "{:.2f}%" .format(self.get_loss(sent, rcvd)),
+                     "Stats": RttStats.from_delays(delays), "SchedDelay": sched_delay, "Timestamp": timestamp})
+
+    @classmethod
+    def combine(cls, first, second):
+        """
+        合并同一目标先后两次ping的结果(自适应策略加测时使用)
+        """
+        sent, rcvd = first['Sent'] + second['Sent'], first['Rcvd'] + second['Rcvd']
+        stats = RttStats()
+        stats.merge(first['Stats'])
+        stats.merge(second['Stats'])
+        if first['Status'] == "Error" or second['Status'] == "Error":
+            status = "Error"
+        else:
+            status = "Success" if rcvd else "Failed"
+        return dict(second, Status=status, Sent=sent, Rcvd=rcvd, Stats=stats,
+                    Loss="{:.2f}%".format(cls.get_loss(sent, rcvd)),
+                    SchedDelay=second['SchedDelay'] or first['SchedDelay'])
+
+
+class AsyncPinger(Pinger):
+    def __init__(self, host, count=DEFAULT_COUNT, timeout=DEFAULT_TIMEOUT, wait=DEFAULT_WAIT, pipeline=False,
+                 size=DEFAULT_PACKET_SIZE, limiter=None):
+        """
+        asyncio版本的Pinger，参数同Pinger
+        :param limiter: asyncio.Semaphore，限制在途探测数
+        """
+        super(AsyncPinger, self).__init__(host, count=count, timeout=timeout, wait=wait, pipeline=pipeline, size=size)
+        self.limiter = limiter
+
+    async def ping_once(self):
+        engine = get_icmp_engine(loop=asyncio.get_event_loop())
+        waiter = engine.register(AsyncProbeWaiter)
+        try:
+            self.send_icmp(engine, waiter.ident, waiter.sequence)
+            return self.note_adjust(waiter, await waiter.wait(self.timeout))
+        finally:
+            engine.unregister(waiter)
+
+    async def ping(self):
+        if self.pipeline:
+            return await self.ping_pipelined()
+        sent = 0
+        rcvd = 0
+        status = "Success"
+        delays = []
+        for i in range(self.count):
+            try:
+                sent += 1
+                if self.limiter is None:
+                    delay = await self.ping_once()
+                else:
+                    async with self.limiter:
+                        delay = await self.ping_once()
+            except OSError as ge:
+                status = "Error"
+                log.warning("%s Ping failed. (socket error: '%s')", self.target_host, ge)
+                break
+            delays.append(delay)
+            if delay is None:
+                pass
+            else:
+                rcvd += 1
+                await asyncio.sleep(self.wait / 1000)
+        return self.ping_result(status, sent, rcvd, delays)
+
+    async def ping_pipelined(self):
+        """
+        Pinger.ping_pipelined的asyncio版本，limiter按在途探测计数，每个探测收到回包或超时后立即释放
+        """
+        engine = get_icmp_engine(loop=asyncio.get_event_loop())
+        sent = 0
+        status = "Success"
+        collectors = []
+        for i in range(self.count):
+            if i:
+                await asyncio.sleep(self.wait / 1000)
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            waiter = engine.register(AsyncProbeWaiter)
+            collectors.append(asyncio.ensure_future(self.collect(engine, waiter, time.time() + self.timeout)))
+            try:
+                sent += 1
+                self.send_icmp(engine, waiter.ident, waiter.sequence)
+            except OSError as ge:
+                status = "Error"
+                log.warning("%s Ping failed. (socket error: '%s')", self.target_host, ge)
+                break
+        delays = await asyncio.gather(*collectors)
+        rcvd = len([delay for delay in delays if delay is not None])
+        return self.ping_result(status, sent, rcvd, delays)
+
+    async def collect(self, engine, waiter, deadline):
+        try:
+            return self.note_adjust(waiter, await waiter.wait(max(0, deadline - time.time())))
+        finally:
+            engine.unregister(waiter)
+            if self.limiter is not None:
+                self.limiter.release()
+
+
+class PathTracer(Pinger):
+    def __init__(self, host, max_hops=DEFAULT_MTR_MAX_HOPS, probes=DEFAULT_MTR_PROBES, timeout=DEFAULT_TIMEOUT,
+                 wait=DEFAULT_WAIT):
+        """
+        内置路径追踪：复用Pinger的报文，按递增的IP TTL发送Echo Request，读取沿途路由器返回的Time Exceeded
+        每一轮同时向所有跳发出探测，所有目标共用IcmpEngine的同一个socket
+        :param host: IP地址或域名
+        :param max_hops: 最大跳数
+        :param probes: 每跳探测次数(轮数)
+        :param timeout: 最后一轮发出后等待回包的时间，单位秒
+        :param wait: 两轮之间的间隔，单位ms
+        """
+        super(PathTracer, self).__init__(host, count=probes, timeout=timeout, wait=wait)
+        self.max_hops = max_hops
+
+    @classmethod
+    def from_settings(cls, host, settings, **kwargs):
+        return cls(host, max_hops=settings.mtr_max_hops, probes=settings.mtr_probes, timeout=settings.timeout,
+                   wait=settings.wait, **kwargs)
+
+    def trace(self):
+        """
+        :return: LIST 每跳一个DICT：Hop、Address、Sent、Rcvd、Loss、Stats
+        :raise socket.gaierror: 域名解析失败
+        """
+        engine = get_icmp_engine()
+        probes = []
+        try:
+            for i in range(self.count):
+                if i:
+                    time.sleep(self.wait / 1000)
+                for ttl in range(1, self.max_hops + 1):
+                    waiter = engine.register(trace=True)
+                    waiter.sent_at = time.monotonic()
+                    probes.append((ttl, waiter))
+                    self.send_icmp(engine, waiter.ident, waiter.sequence, ttl)
+            deadline = time.time() + self.timeout
+            for ttl, waiter in probes:
+                waiter.wait(max(0, deadline - time.time()))
+        finally:
+            for ttl, waiter in probes:
+                engine.unregister(waiter)
+        return self.hops(probes)
+
+    def hops(self, probes):
+        """
+        按跳汇总探测结果，到达目标(Echo Reply或Destination Unreachable)后的跳丢弃，末尾无响应的跳只保留一个
+        """
+        target_addr = get_dns_cache().lookup(self.target_host)
+        delays = dict((ttl, []) for ttl in range(1, self.max_hops + 1))
+        addrs = {}
+        last_ttl = self.max_hops
+        last_seen = 0
+        for ttl, waiter in probes:
+            delays[ttl].append(waiter.delay)
+            if waiter.delay is None:
+                continue
+            last_seen = max(last_seen, ttl)
+            addrs.setdefault(ttl, waiter.addr or target_addr)
+            if waiter.icmp_type in (ICMP_ECHO_REPLY, ICMP_DEST_UNREACH):
+                last_ttl = min(last_ttl, ttl)
+        if last_ttl == self.max_hops:
+            last_ttl = min(last_seen + 1, self.max_hops)
+        hops = []
+        for ttl in range(1, last_ttl + 1):
+            sent = len(delays[ttl])
+            rcvd = len([delay for delay in delays[ttl] if delay is not None])
+            hops.append(dict({"Hop": ttl, "Address": addrs.get(ttl, '???'), "Sent": sent, "Rcvd": rcvd,
+                              "Loss": "{:.2f}%".format(self.get_loss(sent, rcvd) or 0.0),
+                              "Stats": RttStats.from_delays(delays[ttl])}))
+        return hops
+
+    @staticmethod
+    def report(host, hops):
+        """
+        :return: LIST 与mtr -r类似的文本报告
+        """
+        lines = ['HOST: %-38s %7s %5s %7s %7s %7s %7s' % (host, 'Loss%', 'Snt', 'Avg', 'Best', 'Wrst', 'StDev')]
+        for hop in hops:
+            stats = hop['Stats']
+            values = ['%7s' % ('' if v is None else '%.1f' % v) for v in (stats.avg, stats.min, stats.max, stats.stddev)]
+            lines.append('%3d.|-- %-36s %7s %5d %s' % (hop['Hop'], hop['Address'], hop['Loss'], hop['Sent'], ' '.join(values)))
+        return lines
+
+
+class ResultAggregator(object):
+    def __init__(self):
+        """
+        按IP累计发送包、接收包和RttStats，在记录产生时增量更新，任何时候都能以O(IP数)输出汇总
+        """
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, ip, sent, rcvd, stats=None):
+        with self._lock:
+            counter = self._counters.get(ip)
+            if counter is None:
+                counter = self._counters[ip] = [0, 0, RttStats()]
+            counter[0] += sent
+            counter[1] += rcvd
+            counter[2].merge(stats)
+
+    @classmethod
+    def from_record_file(cls, record_file):
+        """
+        单次流式读取check-ip-record.csv，不把整个文件读入内存
+        """
+        aggregator = cls()
+        with open(record_file, 'r', newline='') as f_csv:
+            csv_reader = csv.reader(f_csv)
+            headers = next(csv_reader, None)
+            if headers is not None:
+                aggregator.add_rows(headers, csv_reader)
+        return aggregator
+
+    @classmethod
+    def from_store(cls, store_dir):
+        """
+        读取二进制记录(SegmentStore)汇总，二进制记录不含直方图，分位数按各行的最大值近似
+        """
+        aggregator = cls()
+        aggregator.add_rows(RECORD_CSV_HEADERS, SegmentReader(store_dir).csv_rows())
+        return aggregator
+
+    def add_rows(self, headers, rows):
+        """
+        :param headers: 记录文件的表头
+        :param rows: 可迭代的记录行
+        :return: INT 计入汇总的行数
+        """
+        ip_idx, sent_idx, rcvd_idx = headers.index('IP'), headers.index('Sent'), headers.index('Rcvd')
+        # 旧版本的记录文件没有RTT列
+        rtt_idx = [headers.index(name) for name in RTT_CSV_HEADERS] if 'Hist' in headers else None
+        hist_idx = headers.index('Hist') if 'Hist' in headers else None
+        count = 0
+        for row in rows:
+            if len(row) < len(headers) or row[ip_idx] == 'IP':
+                continue
+            rcvd = int(row[rcvd_idx])
+            stats = None
+            if rtt_idx is not None:
+                stats = RttStats.from_record(rcvd, [row[i] for i in rtt_idx], row[hist_idx])
+            self.add(row[ip_idx], int(row[sent_idx]), rcvd, stats)
+            count += 1
+        return count
+
+    def items(self):
+        """
+        :return: LIST (ip, Sent, Rcvd, RttStats)
+        """
+        with self._lock:
+            return [(ip, counter[0], counter[1], counter[2]) for ip, counter in self._counters.items()]
+
+    def __len__(self):
+        return len(self._counters)
+
+    def __contains__(self, ip):
+        return ip in self._counters
+
+    def rows(self):
+        with self._lock:
+            counters = [(ip, counter[0], counter[1], counter[2].fields()) for ip, counter in self._counters.items()]
+        for ip, sent_sum, rcvd_sum, rtt_fields in counters:
+            loss = (sent_sum - rcvd_sum) / sent_sum * 100 if sent_sum else 0.0
+            yield [ip, sent_sum, rcvd_sum, "{:.2f}%".format(loss)] + rtt_fields
+
+    def write_summary(self, result_csv_file):
+        with open(result_csv_file, 'w+', newline='') as f_sum:
+            csv_ops = csv.writer(f_sum)
+            csv_ops.writerow(SUM_CSV_HEADERS)
+            csv_ops.writerows(self.rows())
+
+
+_result_aggregators = {}
+_result_aggregators_lock = threading.Lock()
+
+
+def get_result_aggregator(record_dir, create=True):
+    """
+    :param create: 不存在时是否创建
+    :return: 记录目录对应的ResultAggregator，由ResultSink在写入记录时更新
+    """
+    with _result_aggregators_lock:
+        aggregator = _result_aggregators.get(record_dir)
+        if aggregator is None and create:
+            aggregator = _result_aggregators[record_dir] = ResultAggregator()
+        return aggregator
+
+
+def set_result_aggregator(record_dir, aggregator):
+    """
+    为记录目录指定ResultAggregator，--resume时使用由检查点恢复的汇总
+    """
+    with _result_aggregators_lock:
+        _result_aggregators[record_dir] = aggregator
+
+
+class Checkpoint(object):
+    def __init__(self, aggregator=None, policy=None, dues=None, record_offset=None, store_position=None,
+                 created=None):
+        """
+        记录目录下的检查点文件checkpoint：第一行是JSON格式的元数据，之后每个目标一行CSV，
+        依次为IP、Sent、Rcvd、RttStats.state()各项、直方图、自适应探测的历史、下一次探测的时间
+        检查点由写线程在写盘之后生成，其中的汇总恰好对应记录文件的前record_offset字节(或二进制记录的store_position)，
+        恢复时只需读取这之后的记录
+        :param aggregator: ResultAggregator
+        :param policy: DICT ProbePolicy.state()
+        :param dues: ProbeScheduler.state()的ScheduleState，或从检查点读出的DICT
+        :param record_offset: check-ip-record.csv中己计入汇总的字节数，不写csv时为None
+        :param store_position: 二进制记录中己计入汇总的位置 [段号, 行数]，不写二进制记录时为None
+        """
+        self.aggregator = aggregator if aggregator is not None else ResultAggregator()
+        self.policy = policy or {}
+        self.dues = dues or {}
+        self.record_offset = record_offset
+        self.store_position = store_position
+        self.created = created
+        self.tail_rows = 0
+
+    @staticmethod
+    def path(record_dir):
+        return os.path.join(record_dir, 'checkpoint')
+
+    def write(self, record_dir):
+        """
+        先写临时文件再替换，中途被终止时原有的检查点仍然完整
+        """
+        path = self.path(record_dir)
+        meta = dict(version=1, created=time.time(), targets=len(self.aggregator),
+                    record_offset=self.record_offset, store_position=self.store_position)
+        with open(path + '.tmp', 'w', newline='') as f_checkpoint:
+            f_checkpoint.write(json.dumps(meta) + '\n')
+            csv_ops = csv.writer(f_checkpoint)
+            for ip, sent, rcvd, stats in self.aggregator.items():
+                state = ['' if value is None else repr(value) for value in stats.state()]
+                csv_ops.writerow([ip, sent, rcvd] + state + [stats.encode()] + self.probe_state(ip))
+            # 还没有记录的目标只保存探测状态，逐个判断，不把全部目标展开成集合
+            for ip in self.policy:
+                if ip not in self.aggregator:
+                    csv_ops.writerow([ip, 0, 0, 0, '', '', 0, 0, 0, 0, ''] + self.probe_state(ip))
+            for ip in self.dues:
+                if ip not in self.aggregator and ip not in self.policy:
+                    csv_ops.writerow([ip, 0, 0, 0, '', '', 0, 0, 0, 0, ''] + self.probe_state(ip))
+            f_checkpoint.flush()
+            os.fsync(f_checkpoint.fileno())
+        os.replace(path + '.tmp', path)
+
+    def probe_state(self, ip):
+        due = self.dues.get(ip)
+        return [self.policy.get(ip, ''), repr(due) if due is not None else '']
+
+    @classmethod
+    def load(cls, record_dir):
+        """
+        :return: Checkpoint，没有检查点时返回None
+        :raise ValueError: 检查点内容有误
+        """
+        path = cls.path(record_dir)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', newline='') as f_checkpoint:
+            meta = json.loads(f_checkpoint.readline())
+            checkpoint = cls(record_offset=meta.get('record_offset'), store_position=meta.get('store_position'),
+                             created=meta.get('created'))
+            for row in csv.reader(f_checkpoint):
+                if len(row) < 13:
+                    raise ValueError("检查点[%s]内容不完整" % path)
+                ip = row[0]
+                sent, rcvd = int(row[1]), int(row[2])
+                if sent:
+                    checkpoint.aggregator.add(ip, sent, rcvd, RttStats.from_state(row[3:10], row[10]))
+                if row[11]:
+                    checkpoint.policy[ip] = int(row[11])
+                if row[12]:
+                    checkpoint.dues[ip] = float(row[12])
+        return checkpoint
+
+
+def trim_record_file(record_file):
+    """
+    进程被强制终止时记录文件末尾可能只写了半行，续写前截掉
+    """
+    if not os.path.exists(record_file):
+        return
+    with open(record_file, 'rb+') as f_record:
+        size = f_record.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            f_record.seek(max(0, end - 4096))
+            chunk = f_record.read(end - max(0, end - 4096))
+            position = chunk.rfind(b'\n')
+            if position >= 0:
+                end = end - len(chunk) + position + 1
+                break
+            end = max(0, end - 4096)
+        if end != size:
+            f_record.truncate(end)
+
+
+def load_checkpoint(record_dir, record_format=DEFAULT_RECORD_FORMAT):
+    """
+    由检查点恢复记录目录的汇总：检查点中的汇总加上检查点之后写入的记录，耗时与目标数和检查点之后的记录数成正比；
+    没有可用的检查点时完整读取一遍记录
+    :param record_format: 写入该目录时的记录格式，同时写两种格式时以csv为准
+    :return: Checkpoint
+    """
+    record_file = os.path.join(record_dir, 'check-ip-record.csv')
+    store_dir = os.path.join(record_dir, 'store')
+    use_csv = record_format != 'binary' or not os.path.isdir(store_dir)
+    try:
+        checkpoint = Checkpoint.load(record_dir)
+    except (OSError, ValueError) as ce:
+        cprint("red", "检查点读取失败，重新读取全部记录：%s" % str(ce))
+        checkpoint = None
+    if checkpoint is not None:
+        try:
+            if use_csv and checkpoint.record_offset is not None and os.path.exists(record_file):
+                with open(record_file, 'r', newline='') as f_csv:
+                    headers = next(csv.reader([f_csv.readline()]), None)
+                    f_csv.seek(max(checkpoint.record_offset, f_csv.tell()))
+                    if headers is not None:
+                        checkpoint.tail_rows = checkpoint.aggregator.add_rows(headers, csv.reader(f_csv))
+                return checkpoint
+            if not use_csv and checkpoint.store_position is not None:
+                tail = SegmentReader(store_dir).csv_rows_after(*checkpoint.store_position)
+                checkpoint.tail_rows = checkpoint.aggregator.add_rows(RECORD_CSV_HEADERS, tail)
+                return checkpoint
+        except (OSError, ValueError) as te:
+            cprint("red", "检查点之后的记录无法读取，重新读取全部记录：%s" % str(te))
+        checkpoint = Checkpoint(policy=checkpoint.policy, dues=checkpoint.dues)
+    else:
+        checkpoint = Checkpoint()
+    if use_csv and os.path.exists(record_file):
+        checkpoint.aggregator = ResultAggregator.from_record_file(record_file)
+    elif os.path.isdir(store_dir):
+        checkpoint.aggregator = ResultAggregator.from_store(store_dir)
+    return checkpoint
+
+
+class SegmentStore(object):
+    def __init__(self, store_dir, segment_rows=DEFAULT_RECORD_SEGMENT_ROWS):
+        """
+        二进制记录：每条ping记录是一个定长的STORE_ROW，按写入顺序追加到当前段文件segment-NNNNNN.bin，
+        满segment_rows行后封存：段内记录按(目标, 时间)重排，并生成索引segment-NNNNNN.idx，
+        查询时按索引中的时间范围跳过整段，按目标二分定位，只读取该目标在该时间段内的行
+        域名写入names.txt，记录中用序号代替(0.0.0.0/8不会是探测目标)
+        只由ResultSink的写线程调用
+        :param store_dir: 存放段文件的目录
+        :param segment_rows: 每段行数
+        """
+        self.store_dir = store_dir
+        self.segment_rows = max(1, segment_rows)
+        os.makedirs(store_dir, exist_ok=True)
+        self._names = {}
+        self._f_names = open(os.path.join(store_dir, 'names.txt'), 'a+')
+        self._f_names.seek(0)
+        for line in self._f_names:
+            self._names[line.rstrip('\n')] = len(self._names)
+        segments = SegmentReader.segment_numbers(store_dir)
+        self._segment = segments[-1] if segments else 1
+        self._f_segment = None
+        self._rows = 0
+        self._open_segment()
+
+    def segment_path(self, number, suffix='bin'):
+        return os.path.join(self.store_dir, 'segment-%06d.%s' % (number, suffix))
+
+    def _open_segment(self):
+        # 上次未封存的段继续写；己封存的段不再追加
+        if os.path.exists(self.segment_path(self._segment, 'idx')):
+            self._segment += 1
+        self._f_segment = open(self.segment_path(self._segment), 'ab')
+        self._rows = self._f_segment.tell() // STORE_ROW.size
+        # 进程被强制终止时末尾可能只写了半行
+        if self._f_segment.tell() != self._rows * STORE_ROW.size:
+            self._f_segment.truncate(self._rows * STORE_ROW.size)
+
+    def position(self):
+        """
+        :return: LIST [段号, 行数] 下一行记录写入的位置，用于检查点
+        """
+        return [self._segment, self._rows]
+
+    def address(self, ip):
+        try:
+            return IPV4_ADDRESS.unpack(socket.inet_pton(socket.AF_INET, ip))[0]
+        except (OSError, ValueError):
+            index = self._names.get(ip)
+            if index is None:
+                index = self._names[ip] = len(self._names)
+                self._f_names.write(ip + '\n')
+                self._f_names.flush()
+            return index
+
+    def pack(self, timestamp, ip, sent, rcvd, stats, policy='', sched_delay=''):
+        values = [math.nan if value is None else value for value in stats.values()]
+        values.append(float(sched_delay) if sched_delay else math.nan)
+        policy = STORE_POLICIES.index(policy) if policy in STORE_POLICIES else 0
+        return STORE_ROW.pack(timestamp, self.address(ip), min(sent, 0xFFFF), min(rcvd, 0xFFFF), policy, *values)
+
+    def write(self, rows):
+        """
+        :param rows: LIST pack生成的记录
+        """
+        while rows:
+            room = self.segment_rows - self._rows
+            self._f_segment.write(b''.join(rows[:room]))
+            self._rows += len(rows[:room])
+            rows = rows[room:]
+            if self._rows >= self.segment_rows:
+                self.seal()
+                self._open_segment()
+        self._f_segment.flush()
+
+    def seal(self):
+        """
+        封存当前段：按(目标, 时间)重排并生成索引
+        """
+        self._f_segment.close()
+        path = self.segment_path(self._segment)
+        with open(path, 'rb') as f_segment:
+            data = f_segment.read()
+        usable = len(data) - len(data) % STORE_ROW.size
+        records = [data[i:i + STORE_ROW.size] for i in range(0, usable, STORE_ROW.size)]
+        records.sort(key=lambda record: STORE_KEY.unpack_from(record)[::-1])
+        targets = array('I')
+        starts = array('I')
+        t_min = t_max = 0
+        for n, record in enumerate(records):
+            timestamp, address = STORE_ROW.unpack_from(record)[:2]
+            t_min = timestamp if n == 0 else min(t_min, timestamp)
+            t_max = max(t_max, timestamp)
+            if not targets or targets[-1] != address:
+                targets.append(address)
+                starts.append(n)
+        with open(path + '.tmp', 'wb') as f_sorted:
+            f_sorted.write(b''.join(records))
+            f_sorted.flush()
+            os.fsync(f_sorted.fileno())
+        os.replace(path + '.tmp', path)
+        index_path = self.segment_path(self._segment, 'idx')
+        with open(index_path + '.tmp', 'wb') as f_index:
+            f_index.write(STORE_INDEX_HEADER.pack(STORE_INDEX_MAGIC, 1, t_min, t_max, len(records), len(targets)))
+            f_index.write(targets.tobytes())
+            f_index.write(starts.tobytes())
+        os.replace(index_path + '.tmp', index_path)
+
+    def close(self):
+        """
+        封存当前段(有数据时)并关闭文件
+        """
+        if self._rows:
+            self.seal()
+            self._segment += 1
+            self._rows = 0
+        else:
+            self._f_segment.close()
+        self._f_names.close()
+
+
+class SegmentReader(object):
+    def __init__(self, store_dir):
+        """
+        用mmap读取SegmentStore，只映射查询涉及的段
+        """
+        if not os.path.isdir(store_dir):
+            raise ValueError("目录[%s]中没有二进制记录" % store_dir)
+        self.store_dir = store_dir
+        names_file = os.path.join(store_dir, 'names.txt')
+        self.names = []
+        if os.path.exists(names_file):
+            with open(names_file, 'r') as f_names:
+                self.names = [line.rstrip('\n') for line in f_names]
+
+    @staticmethod
+    def segment_numbers(store_dir):
+        numbers = []
+        for name in os.listdir(store_dir):
+            if name.startswith('segment-') and name.endswith('.bin'):
+                numbers.append(int(name[8:-4]))
+        return sorted(numbers)
+
+    def address(self, ip):
+        """
+        :return: INT 记录中的目标编号，不在记录中的域名返回None
+        """
+        try:
+            return IPV4_ADDRESS.unpack(socket.inet_pton(socket.AF_INET, ip))[0]
+        except (OSError, ValueError):
+            return self.names.index(ip) if ip in self.names else None
+
+    def target(self, address):
+        if address < len(self.names) and address < 0x1000000:
+            return self.names[address]
+        return socket.inet_ntoa(IPV4_ADDRESS.pack(address))
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as f_map:
+            if os.fstat(f_map.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f_map.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def segments(self):
+        """
+        :return: 可迭代的 (段文件, 索引文件或None)，未封存的段没有索引
+        """
+        for number in self.segment_numbers(self.store_dir):
+            path = os.path.join(self.store_dir, 'segment-%06d.bin' % number)
+            index_path = os.path.join(self.store_dir, 'segment-%06d.idx' % number)
+            yield path, index_path if os.path.exists(index_path) else None
+
+    def query(self, ip=None, start=None, end=None):
+        """
+        :param ip: 目标，None为全部
+        :param start: 起始时间(含)，纳秒，None为不限
+        :param end: 结束时间(不含)，纳秒，None为不限
+        :return: 可迭代的STORE_ROW元组
+        """
+        address = None if ip is None else self.address(ip)
+        if ip is not None and address is None:
+            return
+        start = -1 << 63 if start is None else start
+        end = (1 << 63) - 1 if end is None else end
+        for path, index_path in self.segments():
+            data = self._map(path)
+            if data is None:
+                continue
+            try:
+                rows = len(data) // STORE_ROW.size
+                first, last = 0, rows
+                if index_path is not None:
+                    index = self._map(index_path)
+                    try:
+                        magic, version, t_min, t_max, rows, n_targets = STORE_INDEX_HEADER.unpack_from(index)
+                        if t_max < start or t_min >= end:
+                            continue
+                        if address is not None:
+                            targets = memoryview(index)[STORE_INDEX_HEADER.size:].cast('I')[:n_targets]
+                            position = bisect.bisect_left(targets, address)
+                            if position == n_targets or targets[position] != address:
+                                targets.release()
+                                continue
+                            starts = memoryview(index)[STORE_INDEX_HEADER.size + 4 * n_targets:].cast('I')[:n_targets]
+                            first = starts[position]
+                            last = starts[position + 1] if position + 1 < n_targets else rows
+                            starts.release()
+                            targets.release()
+                    finally:
+                        index.close()
+                for n in range(first, last):
+                    row = STORE_ROW.unpack_from(data, n * STORE_ROW.size)
+                    if (address is None or row[1] == address) and start <= row[0] < end:
+                        yield row
+            finally:
+                data.close()
+
+    def loss(self, ip, start=None, end=None):
+        """
+        :return: TUPLE (Sent, Rcvd, 丢包率%)
+        """
+        sent = rcvd = 0
+        for row in self.query(ip, start, end):
+            sent += row[2]
+            rcvd += row[3]
+        return sent, rcvd, (sent - rcvd) / sent * 100 if sent else 0.0
+
+    def csv_rows(self, ip=None, start=None, end=None):
+        """
+        :return: 可迭代的与RECORD_CSV_HEADERS对应的行，二进制记录不含直方图，Hist列为空
+        """
+        for row in self.query(ip, start, end):
+            yield self.csv_row(row)
+
+    def csv_row(self, row):
+        timestamp, address, sent, rcvd, policy = row[:5]
+        values = ['' if math.isnan(value) else "{:.3f}".format(value) for value in row[5:]]
+        loss = (sent - rcvd) / sent * 100 if sent else 0.0
+        return [datetime.datetime.fromtimestamp(timestamp / 1e9).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                self.target(address), sent, rcvd, "{:.2f}%".format(loss)] + values[:8] + \
+            ['', values[8], STORE_POLICIES[policy] if policy < len(STORE_POLICIES) else '']
+
+    def csv_rows_after(self, segment, rows):
+        """
+        检查点之后写入的记录：第segment段第rows行之后，以及之后的各段
+        :raise ValueError: 第segment段在检查点之后己封存，段内己重排，无法按行号定位
+        """
+        if os.path.exists(os.path.join(self.store_dir, 'segment-%06d.idx' % segment)) and rows:
+            raise ValueError("第%d段在检查点之后己封存" % segment)
+        for number in self.segment_numbers(self.store_dir):
+            if number < segment:
+                continue
+            data = self._map(os.path.join(self.store_dir, 'segment-%06d.bin' % number))
+            if data is None:
+                continue
+            try:
+                first = rows if number == segment else 0
+                for n in range(first, len(data) // STORE_ROW.size):
+                    yield self.csv_row(STORE_ROW.unpack_from(data, n * STORE_ROW.size))
+            finally:
+                data.close()
+
+    def export_csv(self, csv_file, ip=None, start=None, end=None):
+        """
+        导出为check-ip-record.csv的格式，段内按目标排序，导出的行不保证按时间排序
+        :return: INT 导出的行数
+        """
+        count = 0
+        with open(csv_file, 'w', newline='') as f_csv:
+            csv_ops = csv.writer(f_csv)
+            csv_ops.writerow(RECORD_CSV_HEADERS)
+            for row in self.csv_rows(ip, start, end):
+                csv_ops.writerow(row)
+                count += 1
+        return count
+
+
+def parse_record_time(text):
+    """
+    :param text: "YYYY-mm-dd HH:MM:SS"，可省略时间部分
+    :return: INT 纳秒，text为空时返回None
+    """
+    if not text:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(datetime.datetime.strptime(text, fmt).timestamp()) * 1000000000
+        except ValueError:
+            continue
+    raise ValueError("时间格式应为 YYYY-mm-dd HH:MM:SS: %s" % text)
+
+
+_result_sinks = {}
+_result_sinks_lock = threading.Lock()
+
+
+class ResultSink(object):
+    def __init__(self, record_dir, batch_size=DEFAULT_RECORD_BATCH_SIZE, flush_interval=DEFAULT_RECORD_FLUSH_INTERVAL,
+                 aggregator=None, record_format=DEFAULT_RECORD_FORMAT, segment_rows=DEFAULT_RECORD_SEGMENT_ROWS,
+                 checkpoint_interval=DEFAULT_RECORD_CHECKPOINT_INTERVAL):
+        """
+        结果写入队列：各探测线程/协程只把记录放入队列，由唯一的写线程批量写入文件
+        :param record_dir: 记录目录
+        :param batch_size: 积累多少条记录后写盘
+        :param flush_interval: 距上次写盘超过多少秒后写盘
+        :param aggregator: ResultAggregator，写入的每条ping记录同时计入汇总
+        :param record_format: ping记录格式：csv、binary(写入record_dir/store下的SegmentStore)或both
+        :param segment_rows: 二进制记录每段行数
+        :param checkpoint_interval: 每隔多少秒写一次检查点，0为不写；检查点由写线程在写盘后生成，关闭时再写一次
+        """
+        self.record_dir = record_dir
+        self.aggregator = aggregator
+        self.checkpoint_interval = checkpoint_interval
+        # 持续监测模式的调度器，其状态随检查点保存
+        self.scheduler = None
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._closed = False
+        self._f_csv = None
+        self._csv_ops = None
+        self.store = None
+        if record_format in ('csv', 'both'):
+            csv_file = os.path.join(record_dir, 'check-ip-record.csv')
+            write_header = not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0
+            self._f_csv = open(csv_file, 'a+', newline='')
+            self._csv_ops = csv.writer(self._f_csv)
+            if write_header:
+                self._csv_ops.writerow(RECORD_CSV_HEADERS)
+                self._f_csv.flush()
+        if record_format in ('binary', 'both'):
+            self.store = SegmentStore(os.path.join(record_dir, 'store'), segment_rows)
+        self._f_mtr = open(os.path.join(record_dir, 'mtr-ip-check.log'), 'a+')
+        self._f_hop = None
+        self._hop_ops = None
+        self._writer = threading.Thread(target=self._write_loop, name='result-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def put_ping(self, ip, ping_ip_result):
+        stats = ping_ip_result['Stats']
+        row = [ping_ip_result['Time'], ip, ping_ip_result['Sent'], ping_ip_result['Rcvd'], ping_ip_result['Loss']]
+        row.extend(stats.fields())
+        row.append(stats.encode())
+        row.append(ping_ip_result.get('SchedDelay', ''))
+        row.append(ping_ip_result.get('Policy', ''))
+        record = None
+        if self.store is not None:
+            record = (ping_ip_result.get('Timestamp') or time.time_ns(), ip, ping_ip_result['Sent'],
+                      ping_ip_result['Rcvd'], stats, ping_ip_result.get('Policy', ''),
+                      ping_ip_result.get('SchedDelay', ''))
+        self._queue.put(('ping', row, stats, record))
+
+    def put_mtr(self, lines):
+        """
+        :param lines: LIST 写入mtr日志的文本行
+        """
+        self._queue.put(('mtr', lines))
+
+    def put_hops(self, ip, dt, hops):
+        """
+        :param hops: PathTracer.trace的结果，逐跳写入mtr-hop-record.csv
+        """
+        rows = []
+        for hop in hops:
+            stats = hop['Stats']
+            rows.append([dt, ip, hop['Hop'], hop['Address'], hop['Sent'], hop['Rcvd'], hop['Loss']] + stats.fields()[:4])
+        self._queue.put(('hops', rows))
+
+    def _write_loop(self):
+        rows = []
+        records = []
+        mtr_lines = []
+        hop_rows = []
+        last_flush = last_checkpoint = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                if item[0] == 'ping':
+                    rows.append(item[1])
+                    if item[3] is not None:
+                        records.append(item[3])
+                    if self.aggregator is not None:
+                        self.aggregator.add(item[1][1], item[1][2], item[1][3], item[2])
+                elif item[0] == 'mtr':
+                    mtr_lines.extend(item[1])
+                elif item[0] == 'hops':
+                    hop_rows.extend(item[1])
+            stop = item is not None and item[0] == 'close'
+            if stop or len(rows) + len(mtr_lines) + len(hop_rows) >= self.batch_size or \
+                    time.time() - last_flush >= self.flush_interval:
+                segment = self.store.position()[0] if self.store is not None else None
+                try:
+                    self._flush(rows, mtr_lines, hop_rows, records)
+                except Exception as we:
+                    cprint("red", "ResultSink: %s" % str(we))
+                    print(traceback.format_exc())
+                rows = []
+                records = []
+                mtr_lines = []
+                hop_rows = []
+                last_flush = time.time()
+                # 封存后段内己重排，检查点中的段内行号失效，立即写新的检查点
+                sealed = segment is not None and self.store.position()[0] != segment
+                if not stop and self.checkpoint_interval > 0 and \
+                        (sealed or last_flush - last_checkpoint >= self.checkpoint_interval):
+                    self.write_checkpoint()
+                    last_checkpoint = time.time()
+            if stop:
+                return
+
+    def write_checkpoint(self):
+        """
+        只在写线程中或写线程结束后调用，此时汇总恰好包含己写盘的记录
+        """
+        if self.aggregator is None:
+            return
+        try:
+            checkpoint_start = time.monotonic()
+            record_offset = None
+            if self._f_csv is not None:
+                self._f_csv.flush()
+                os.fsync(self._f_csv.fileno())
+                record_offset = self._f_csv.tell()
+            checkpoint = Checkpoint(self.aggregator, policy=get_probe_policy().state(),
+                                    dues=self.scheduler.state() if self.scheduler is not None else None,
+                                    record_offset=record_offset,
+                                    store_position=self.store.position() if self.store is not None else None)
+            checkpoint.write(self.record_dir)
+            CHECKPOINT_SECONDS.observe(time.monotonic() - checkpoint_start)
+        except Exception as ce:
+            cprint("red", "ResultSink: 写检查点失败: %s" % str(ce))
+            print(traceback.format_exc())
+
+    def _flush(self, rows, mtr_lines, hop_rows=(), records=()):
+        flush_start = time.monotonic()
+        if hop_rows:
+            if self._f_hop is None:
+                hop_file = os.path.join(self.record_dir, 'mtr-hop-record.csv')
+                write_header = not os.path.exists(hop_file) or os.path.getsize(hop_file) == 0
+                self._f_hop = open(hop_file, 'a+', newline='')
+                self._hop_ops = csv.writer(self._f_hop)
+                if write_header:
+                    self._hop_ops.writerow(HOP_CSV_HEADERS)
+            self._hop_ops.writerows(hop_rows)
+            self._f_hop.flush()
+        if rows and self._csv_ops is not None:
+            self._csv_ops.writerows(rows)
+            self._f_csv.flush()
+        if records:
+            self.store.write([self.store.pack(*record) for record in records])
+        WRITER_ROWS.inc(len(rows))
+        WRITER_FLUSH_SECONDS.observe(time.monotonic() - flush_start)
+        if mtr_lines:
+            self._f_mtr.write('\n'.join(mtr_lines) + '\n')
+            self._f_mtr.flush()
+
+    def close(self, timeout=None):
+        """
+        写完队列中剩余的记录并fsync，最多等待timeout秒，None为一直等到写完
+        :return: BOOL 队列中的记录是否全部写入
+        """
+        if self._closed:
+            return not self._writer.is_alive()
+        self._closed = True
+        self._queue.put(('close', None))
+        self._writer.join(timeout)
+        if self._writer.is_alive():
+            # 写线程仍在写盘，不能再关闭文件；上一个检查点和己写入的记录仍然完整
+            cprint("red", "ResultSink: 等待写盘超时，队列中还有%d条记录未写入" % self._queue.qsize())
+            return False
+        if self.store is not None:
+            try:
+                self.store.close()
+            except (OSError, ValueError) as se:
+                cprint("red", "ResultSink: %s" % str(se))
+        if self.checkpoint_interval > 0:
+            self.write_checkpoint()
+        for f in self._f_csv, self._f_mtr, self._f_hop:
+            if f is None:
+                continue
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            except (OSError, ValueError) as fe:
+                cprint("red", "ResultSink: %s" % str(fe))
+        return True
+
+
+def get_result_sink(record_dir):
+    """
+    :return: 记录目录对应的ResultSink，每个目录只有一个写线程
+    """
+    sink = _result_sinks.get(record_dir)
+    if sink is None:
+        with _result_sinks_lock:
+            sink = _result_sinks.get(record_dir)
+            if sink is None:
+                settings = get_settings()
+                sink = ResultSink(record_dir, batch_size=settings.record_batch_size,
+                                  flush_interval=settings.record_flush_interval,
+                                  aggregator=get_result_aggregator(record_dir),
+                                  record_format=settings.record_format, segment_rows=settings.record_segment_rows,
+                                  checkpoint_interval=settings.record_checkpoint_interval)
+                _result_sinks[record_dir] = sink
+    return sink
+
+
+WRITER_QUEUE_DEPTH.func = lambda: sum(sink._queue.qsize() for sink in list(_result_sinks.values())
+                                      if isinstance(sink, ResultSink))
+
+
+def close_result_sinks(timeout=None):
+    """
+    关闭所有写队列，所有目录合计最多等待timeout秒，None为一直等到全部写完
+    :return: BOOL 所有记录是否都己写入
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with _result_sinks_lock:
+        sinks = list(_result_sinks.values())
+        _result_sinks.clear()
+    complete = True
+    for sink in sinks:
+        if not sink.close(None if deadline is None else max(0.0, deadline - time.time())):
+            complete = False
+    return complete
+
+
+class ShardSink(object):
+    def __init__(self, results):
+        """
+        多进程模式下子进程使用的写队列：与ResultSink接口相同，记录通过进程间队列交给父进程写入
+        :param results: multiprocessing.Queue
+        """
+        self._results = results
+        self.scheduler = None
+
+    def put_ping(self, ip, ping_ip_result):
+        self._results.put(('ping', ip, ping_ip_result))
+
+    def put_mtr(self, lines):
+        self._results.put(('mtr', lines))
+
+    def put_hops(self, ip, dt, hops):
+        self._results.put(('hops', ip, dt, hops))
+
+    def close(self, timeout=None):
+        return True
+
+
+def set_result_sink(record_dir, sink):
+    """
+    为记录目录指定写队列，替代默认的ResultSink
+    """
+    with _result_sinks_lock:
+        _result_sinks[record_dir] = sink
+
+
+class MtrDispatcher(object):
+    def __init__(self, record_dir, workers=DEFAULT_MTR_WORKERS, cooldown=DEFAULT_MTR_COOLDOWN,
+                 collapse_prefix=DEFAULT_MTR_COLLAPSE_PREFIX, queue_size=DEFAULT_MTR_QUEUE_SIZE):
+        """
+        ping未通过的IP放入有界队列，由固定数量的线程执行mtr，探测线程不再等待mtr
+        同一目标(或同一网段)在队列中/执行中只保留一个，执行过的目标在冷却时间内不再重复执行
+        :param record_dir: 记录目录
+        :param workers: 同时执行的mtr数
+        :param cooldown: 同一目标两次mtr的最小间隔，单位秒
+        :param collapse_prefix: 大于0时按该前缀长度合并网段，例如24表示同一个/24只执行一次
+        :param queue_size: 队列长度，队列满时丢弃新的请求
+        """
+        self.record_dir = record_dir
+        self.cooldown = cooldown
+        self.collapse_prefix = collapse_prefix
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._pending = set()
+        self._last_traced = {}
+        self._mtr_found = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._work_loop, name='mtr-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def trace_key(self, ip):
+        """
+        :return: 去重、冷却使用的键，开启collapse_prefix时为所在网段
+        """
+        if self.collapse_prefix <= 0 or not DnsCache.is_ip_literal(ip):
+            return ip
+        mask = (0xFFFFFFFF << (32 - min(self.collapse_prefix, 32))) & 0xFFFFFFFF
+        network = struct.unpack("!I", socket.inet_aton(ip))[0] & mask
+        return "%s/%d" % (socket.inet_ntoa(struct.pack("!I", network)), self.collapse_prefix)
+
+    def mtr_available(self, settings):
+        """
+        使用外部mtr时检查程序是否存在，每个路径只检查一次，不存在时只提示一次
+        :return: BOOL 能否执行路径追踪
+        """
+        if settings.mtr_engine == 'native' and native_trace_available():
+            return True
+        with self._lock:
+            found = self._mtr_found.get(settings.mtr_path)
+            if found is None:
+                found = self._mtr_found[settings.mtr_path] = shutil.which(settings.mtr_path) is not None
+                if not found:
+                    cprint("red", "可执行路径中未找到mtr[%s]，请确认mtr是否己安装或指定的mtr路径有误，不再执行mtr" %
+                           settings.mtr_path)
+        return found
+
+    def submit(self, ip, dt, settings):
+        """
+        :param dt: ping检测时间，写入mtr日志
+        :return: 是否放入队列
+        """
+        if not self.mtr_available(settings):
+            return False
+        key = self.trace_key(ip)
+        now = time.time()
+        with self._lock:
+            if key in self._pending:
+                return False
+            last = self._last_traced.get(key)
+            if last is not None and now - last < self.cooldown:
+                return False
+            try:
+                self._queue.put_nowait((key, ip, dt, settings, time.monotonic()))
+            except queue.Full:
+                MTR_DROPPED.inc()
+                log.warning("IP: %s, mtr队列己满，本次不执行mtr", ip)
+                return False
+            self._pending.add(key)
+            return True
+
+    def _work_loop(self):
+        while True:
+            try:
+                key, ip, dt, settings, queued_at = self._queue.get(timeout=self.cooldown or 1)
+            except queue.Empty:
+                self._prune()
+                continue
+            try:
+                started = time.monotonic()
+                MTR_QUEUE_WAIT_SECONDS.observe(started - queued_at)
+                ops = CheckIp(record_dir=self.record_dir, settings=settings)
+                ops.dt = dt
+                mtr_ip_result = ops.mtr_check(ip)
+                MTR_SECONDS.observe(time.monotonic() - started)
+                ops.write_mtr(ip, mtr_ip_result)
+            except Exception as me:
+                cprint("red", "MtrDispatcher: %s" % str(me))
+                print(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                    self._last_traced[key] = time.time()
+                self._queue.task_done()
+
+    def _prune(self):
+        """
+        清理冷却时间己过的记录，避免长时间运行时无限增长
+        """
+        now = time.time()
+        with self._lock:
+            for key, last in list(self._last_traced.items()):
+                if now - last >= self.cooldown:
+                    del self._last_traced[key]
+
+    def wait_idle(self, timeout):
+        """
+        等待队列中的mtr执行完毕，最多等待timeout秒
+        :return: 是否全部执行完毕
+        """
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+_mtr_dispatchers = {}
+_mtr_dispatchers_lock = threading.Lock()
+
+
+def get_mtr_dispatcher(record_dir):
+    """
+    :return: 记录目录对应的MtrDispatcher
+    """
+    dispatcher = _mtr_dispatchers.get(record_dir)
+    if dispatcher is None:
+        with _mtr_dispatchers_lock:
+            dispatcher = _mtr_dispatchers.get(record_dir)
+            if dispatcher is None:
+                settings = get_settings()
+                # 内置追踪只是在等待回包，可以用更多的线程同时追踪
+                native = settings.mtr_engine == 'native' and native_trace_available()
+                workers = settings.mtr_native_workers if native else settings.mtr_workers
+                dispatcher = MtrDispatcher(record_dir, workers=workers, cooldown=settings.mtr_cooldown,
+                                           collapse_prefix=settings.mtr_collapse_prefix,
+                                           queue_size=settings.mtr_queue_size)
+                dispatcher.mtr_available(settings)
+                _mtr_dispatchers[record_dir] = dispatcher
+    return dispatcher
+
+
+MTR_QUEUE_DEPTH.func = lambda: sum(dispatcher._queue.qsize() for dispatcher in list(_mtr_dispatchers.values()))
+
+
+def wait_mtr_dispatchers(timeout):
+    """
+    等待所有mtr调度队列执行完毕，最多等待timeout秒
+    """
+    deadline = time.time() + timeout
+    with _mtr_dispatchers_lock:
+        dispatchers = list(_mtr_dispatchers.values())
+    for dispatcher in dispatchers:
+        if not dispatcher.wait_idle(max(0, deadline - time.time())):
+            cprint("red", "等待mtr执行超时，未执行完的mtr己放弃")
+            return
 
 
 class CheckIp(object):
-    def __init__(self, record_dir=run_path()):
+    def __init__(self, record_dir=run_path(), settings=None, sink=None):
+        """
+        :param record_dir: 记录目录
+        :param settings: Settings，默认使用当前生效的配置
+        :param sink: ResultSink，默认使用记录目录对应的写队列
+        """
         self.start_time = time.time()
         self.dt = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
         self.record_dir = record_dir
+        self.settings = settings if settings is not None else get_settings()
+        self._sink = sink
 
-    @staticmethod
-    def ping_check(ip):
+    @property
+    def sink(self):
+        if self._sink is None:
+            self._sink = get_result_sink(self.record_dir)
+        return self._sink
+
+    def mtr_command(self, ip):
+        """
+        :return: LIST mtr命令行
+        """
+        return [self.settings.mtr_path, ip] + self.settings.mtr_paras.split(' ')
+
+    def ping_check(self, ip):
         """
         :param ip: IP地址
         :return: DICT code: 命令执行状态，result: 结果内容列表
@@ -262,190 +2772,734 @@ class CheckIp(object):
         result_list = []
         try:
             pstart_time = time.time()
-            c = configparser.ConfigParser()
-            c.read(os.path.join(run_path(), 'config'))
-            count = int(c.get('ping', 'count'))
-            wait = int(c.get('ping', 'wait'))
-            timeout = int(c.get('ping', 'timeout'))
-            ping_result = Pinger(host=ip, count=count, wait=wait, timeout=timeout).ping()
+            policy = get_probe_policy()
+            decision, count = policy.decide(ip, self.settings)
+            ping_result = Pinger.from_settings(ip, self.settings, count=count).ping()
+            if decision == 'healthy' and ping_result['Rcvd'] < ping_result['Sent']:
+                decision = 'healthy+escalated'
+                ping_result = Pinger.combine(ping_result, Pinger.from_settings(ip, self.settings).ping())
+            policy.update(ip, ping_result['Sent'], ping_result['Rcvd'])
+            ping_result['Policy'] = decision
             pend_time = time.time()
-            cprint("blue", "IP：%s 执行[ping_check]耗时： %s秒 " % (ip, round((pend_time - pstart_time), 3)))
+            PING_CHECK_SECONDS.observe(pend_time - pstart_time)
+            log.debug("IP：%s 执行[ping_check]耗时： %s秒 ", ip, round((pend_time - pstart_time), 3))
             return ping_result
-        except configparser.Error as ce:
-            cprint("red", "config配置文件中[ping]配置参数存在错误：")
-            print(str(ce))
-            print(traceback.format_exc())
-            sys.exit(1)
         except Exception as pe:
-            cprint("red", "ping_check: %s" % str(pe))
-            print(traceback.format_exc())
+            log.warning("IP:%s, ping_check: %s", ip, pe, exc_info=True)
 
-    @staticmethod
-    def mtr_check(ip):
+    async def ping_check_async(self, ip, limiter=None):
+        """
+        ping_check的asyncio版本
+        :param ip: IP地址
+        :param limiter: asyncio.Semaphore，限制在途探测数
+        """
+        try:
+            pstart_time = time.time()
+            policy = get_probe_policy()
+            decision, count = policy.decide(ip, self.settings)
+            ping_result = await AsyncPinger.from_settings(ip, self.settings, count=count, limiter=limiter).ping()
+            if decision == 'healthy' and ping_result['Rcvd'] < ping_result['Sent']:
+                decision = 'healthy+escalated'
+                second = await AsyncPinger.from_settings(ip, self.settings, limiter=limiter).ping()
+                ping_result = Pinger.combine(ping_result, second)
+            policy.update(ip, ping_result['Sent'], ping_result['Rcvd'])
+            ping_result['Policy'] = decision
+            pend_time = time.time()
+            PING_CHECK_SECONDS.observe(pend_time - pstart_time)
+            log.debug("IP：%s 执行[ping_check]耗时： %s秒 ", ip, round((pend_time - pstart_time), 3))
+            return ping_result
+        except Exception as pe:
+            log.warning("IP:%s, ping_check: %s", ip, pe, exc_info=True)
+
+    def trace_check(self, ip):
+        """
+        使用内置的PathTracer代替外部mtr
+        :param ip: IP地址
+        :return: DICT Status: 0为成功，result: 文本报告，hops: 逐跳结果
+        """
+        try:
+            mstart_time = time.time()
+            hops = PathTracer.from_settings(ip, self.settings).trace()
+            mend_time = time.time()
+            log.debug("IP：%s 执行[trace_check]耗时： %s秒 ", ip, round((mend_time - mstart_time), 3))
+            return dict({'Status': 0, 'result': PathTracer.report(ip, hops), 'hops': hops})
+        except socket.gaierror as ge:
+            log.warning("IP:%s, trace failed. (socket error: '%s')", ip, ge)
+        except Exception as te:
+            log.warning("IP:%s, trace_check: %s", ip, te, exc_info=True)
+
+    def mtr_check(self, ip):
         """
         :param ip: IP地址
         :return: DICT code: 命令执行状态，result: 结果内容列表
         """
+        if self.settings.mtr_engine == 'native' and native_trace_available():
+            return self.trace_check(ip)
         result_list = []
         try:
             mstart_time = time.time()
-            c = configparser.ConfigParser()
-            c.read(os.path.join(run_path(), 'config'))
-            command = [c.get('mtr', 'path'), ip] + c.get('mtr', 'paras').split(' ')
+            command = self.mtr_command(ip)
             mtr_result = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='gbk')
-            stdout, stderr = mtr_result.communicate()
+            try:
+                stdout, stderr = mtr_result.communicate(timeout=self.settings.mtr_timeout)
+            except subprocess.TimeoutExpired:
+                mtr_result.kill()
+                mtr_result.communicate()
+                raise
             exit_code = mtr_result.returncode
             for line in stdout, stderr:
                 if line:
                     result_list.append(line.strip('\n'))
             mend_time = time.time()
-            cprint("blue", "IP：%s 执行[mtr_check]耗时： %s秒 " % (ip, round((mend_time - mstart_time), 3)))
+            log.debug("IP：%s 执行[mtr_check]耗时： %s秒 ", ip, round((mend_time - mstart_time), 3))
             return dict({'Status': exit_code, 'result': result_list})
-        except configparser.Error as ce:
-            cprint("red", "config配置文件中[ping]配置参数存在错误：")
-            print(str(ce))
-            sys.exit(1)
-        except FileNotFoundError as se:
-            print("可执行路径中未找到mtr，请确认mtr是否己安装或指定的mtr路径有误。")
-            sys.exit(1)
+        except FileNotFoundError:
+            log.warning("IP:%s, 可执行路径中未找到mtr，请确认mtr是否己安装或指定的mtr路径有误。", ip)
         except subprocess.TimeoutExpired as se:
-            print("IP:%s, subprocess.TimeoutExpired" % ip)
-            print(str(se))
+            log.warning("IP:%s, subprocess.TimeoutExpired: %s", ip, se)
         except subprocess.CalledProcessError as se:
-            print("IP:%s, subprocess.CalledProcessError" % ip)
-            print(str(se))
+            log.warning("IP:%s, subprocess.CalledProcessError: %s", ip, se)
         except subprocess.SubprocessError as se:
-            print(str(se))
-            print(traceback.format_exc())
+            log.warning("IP:%s, %s", ip, se, exc_info=True)
         except Exception as me:
-            cprint("red", "mtr_check: %s" % str(me))
-            print(traceback.format_exc())
+            log.warning("IP:%s, mtr_check: %s", ip, me, exc_info=True)
+
+    def write_result(self, ip, ping_ip_result):
+        """
+        把一个IP的ping结果放入写队列，ping未通过时把IP交给mtr调度队列
+        :param ip: IP地址
+        :param ping_ip_result: ping_check的结果
+        """
+        if not ping_ip_result:
+            return
+        self.sink.put_ping(ip, ping_ip_result)
+        if ping_ip_result['Status'] != "Success":
+            get_mtr_dispatcher(self.record_dir).submit(ip, self.dt, self.settings)
+
+    def write_mtr(self, ip, mtr_ip_result):
+        """
+        把mtr结果放入写队列
+        :param mtr_ip_result: mtr_check的结果
+        """
+        if mtr_ip_result and mtr_ip_result['Status'] == 0:
+            lines = ['-' * 120, '%s \t %s  执行Mtr的结果: ' % (self.dt, ip)]
+            lines.extend(mtr_line for mtr_line in mtr_ip_result['result'] if mtr_line)
+            lines.append('-' * 120)
+            self.sink.put_mtr(lines)
+            if mtr_ip_result.get('hops'):
+                self.sink.put_hops(ip, self.dt, mtr_ip_result['hops'])
+        else:
+            log.warning("%s \t %s 执行Mtr出错...", self.dt, ip)
+            self.sink.put_mtr(['-' * 120])
 
     def run_ping(self, ip):
         try:
             rstart_time = time.time()
-            with open(os.path.join(self.record_dir, 'check-ip-record.csv'), 'a+') as f_csv, \
-                    open(os.path.join(self.record_dir, 'mtr-ip-check.log'), 'a+') as f_mtr:
-                csv_ops = csv.writer(f_csv)
-                ping_ip_result = self.ping_check(ip)
-                if ping_ip_result:
-                    csv_ops.writerow([ping_ip_result['Time'], ip, ping_ip_result['Sent'], ping_ip_result['Rcvd'], ping_ip_result['Loss']])
-                if ping_ip_result['Status'] is not "Success":
-                    mtr_ip_result = self.mtr_check(ip)
-                    if mtr_ip_result['Status'] == 0:
-                        print('-' * 120, file=f_mtr)
-                        print(self.dt, '\t', ip, ' 执行Mtr的结果: ', file=f_mtr)
-                        for mtr_line in mtr_ip_result['result']:
-                            if mtr_line:
-                                print(mtr_line, file=f_mtr)
-                        print('-' * 120, file=f_mtr)
-                    else:
-                        print(self.dt, '\t', ip, ' 执行Mtr出错...')
-                        print('-' * 120, file=f_mtr)
-            f_mtr.close()
-            f_csv.close()
+            ping_ip_result = self.ping_check(ip)
+            self.write_result(ip, ping_ip_result)
             rend_time = time.time()
-            cprint("blue", "IP：%s的所在子线程总任务执行[ping_check、mtr_check]完毕，耗时： %s秒 " % (ip, round((rend_time - rstart_time), 3)))
+            log.info("IP：%s的所在子线程总任务执行[ping_check]完毕，耗时： %s秒 ", ip, round((rend_time - rstart_time), 3))
         except FileNotFoundError:
-            cprint("red", "IP: %s, 写入文件时出现FileNotFoundError" % ip)
+            log.warning("IP: %s, 写入文件时出现FileNotFoundError", ip)
         except Exception as re:
-            cprint("red", "run_ping: %s" % str(re))
-            print(traceback.format_exc())
+            log.warning("IP:%s, run_ping: %s", ip, re, exc_info=True)
+
+    async def run_ping_async(self, ip, limiter=None):
+        """
+        run_ping的asyncio版本：ping未通过时交给mtr调度队列
+        :param ip: IP地址
+        :param limiter: asyncio.Semaphore，限制在途探测数
+        """
+        try:
+            rstart_time = time.time()
+            ping_ip_result = await self.ping_check_async(ip, limiter)
+            self.write_result(ip, ping_ip_result)
+            rend_time = time.time()
+            log.info("IP：%s的协程任务执行[ping_check]完毕，耗时： %s秒 ", ip, round((rend_time - rstart_time), 3))
+        except FileNotFoundError:
+            log.warning("IP: %s, 写入文件时出现FileNotFoundError", ip)
+        except Exception as re:
+            log.warning("IP:%s, run_ping: %s", ip, re, exc_info=True)
 
     def sum_check_result(self):
+        """
+        输出check-ip-sum.csv：本进程写入过该目录时直接使用在线汇总，否则由检查点加上之后写入的记录得到，
+        没有检查点时流式读取一遍记录文件(或二进制记录)
+        """
         try:
-            read_csv_file = os.path.join(self.record_dir, 'check-ip-record.csv')
             result_csv_file = os.path.join(self.record_dir, 'check-ip-sum.csv')
-            _csv_headers = ['IP', 'Sent', 'Rcvd', 'Loss']
-            df = pandas.DataFrame(pandas.read_csv(read_csv_file))
-            ip_list = list(set(df.IP.values))
-            with open(result_csv_file, 'w+') as f_sum:
-                csv_ops = csv.writer(f_sum)
-                csv_ops.writerow(_csv_headers)
-                for ip in ip_list:
-                    sent_sum = int((df.loc[df["IP"] == ip].head())['Sent'].sum())
-                    rcvd_sum = int((df.loc[df["IP"] == ip].head())['Rcvd'].sum())
-                    csv_ops.writerow([ip, sent_sum, rcvd_sum, "{:.2f}%".format((sent_sum - rcvd_sum) / sent_sum * 100)])
-            f_sum.close()
+            aggregator = get_result_aggregator(self.record_dir, create=False)
+            if aggregator is None:
+                aggregator = load_checkpoint(self.record_dir, self.settings.record_format).aggregator
+            aggregator.write_summary(result_csv_file)
         except Exception as scre:
             cprint("red", "sum_check_result: %s" % str(scre))
             print(traceback.format_exc())
 
 
+class TargetList(object):
+    """
+    iplist的解析结果：IPv4地址、网段、地址范围按数值排序、去重、合并为不重叠的区间，
+    区间用三个数组紧凑存储(每个区间12字节)，遍历时才逐个展开为IP，一个/12网段只占一个区间
+    域名和IPv6地址按原样保存
+    """
+
+    def __init__(self):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.option_ids = array('I')
+        self.names = []
+        self.options = [{}]
+        self._option_index = {(): 0}
+        self.duplicates = 0
+        self._offsets = None
+        self._name_index = None
+
+    def option_id(self, options):
+        key = tuple(sorted(options.items()))
+        option_id = self._option_index.get(key)
+        if option_id is None:
+            option_id = self._option_index[key] = len(self.options)
+            self.options.append(options)
+        return option_id
+
+    @staticmethod
+    def parse_target(target):
+        """
+        :return: TUPLE (起始地址, 结束地址)，不是IPv4地址/网段/范围时返回None
+            10.0.0.1 / 10.0.0.0/24 / 10.0.0.1-10.0.0.50 / 10.0.0.1-50
+        网段不包含网络地址和广播地址(/31、/32除外)
+        """
+        try:
+            if '/' in target:
+                network = ipaddress.ip_network(target, strict=False)
+                if network.version != 4:
+                    return None
+                start, end = int(network.network_address), int(network.broadcast_address)
+                if network.prefixlen < 31:
+                    start, end = start + 1, end - 1
+                return start, end
+            first, sep, last = target.partition('-')
+            start = IPV4_ADDRESS.unpack(socket.inet_pton(socket.AF_INET, first))[0]
+            if not sep:
+                return start, start
+            if '.' in last:
+                end = IPV4_ADDRESS.unpack(socket.inet_pton(socket.AF_INET, last))[0]
+            else:
+                last = int(last)
+                if not 0 <= last <= 255:
+                    raise ValueError("结束地址超出0-255")
+                end = (start & 0xFFFFFF00) | last
+            if end < start:
+                raise ValueError("结束地址小于起始地址")
+            return start, end
+        except (OSError, ValueError):
+            if '/' in target or ('-' in target and DnsCache.is_ip_literal(target.partition('-')[0])):
+                raise ValueError("无效的网段或地址范围: %s" % target)
+            return None
+
+    @classmethod
+    def from_file(cls, file):
+        """
+        逐行读取iplist，每行一个IP、网段、地址范围或域名，后面可以跟 key=value 形式的选项，例如：
+            10.0.0.1 interval=30
+            10.1.0.0/16
+            10.2.0.1-10.2.0.100
+        以@开头的行定义分组，其选项作为后续各行的默认值，直到下一个分组：
+            @core interval=5
+        #之后为注释；重复或重叠的地址只保留一次，重叠部分使用起始地址较小的一行的选项
+        """
+        target_list = cls()
+        starts, ends, option_ids = array('I'), array('I'), array('I')
+        seen_names = set()
+        defaults = {}
+        default_id = 0
+        in_order = True
+        with open(file, "r") as f_ip_lists:
+            for line_no, line in enumerate(f_ip_lists, 1):
+                if '#' in line:
+                    line = line.split('#', 1)[0]
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) == 1 and fields[0][0] != '@':
+                    option_id = default_id
+                else:
+                    options = dict(defaults)
+                    for field in fields[1:]:
+                        key, sep, value = field.partition('=')
+                        if sep:
+                            options[key.strip().lower()] = value.strip()
+                    if fields[0].startswith('@'):
+                        defaults = options
+                        default_id = target_list.option_id(options)
+                        continue
+                    option_id = target_list.option_id(options)
+                try:
+                    address_range = cls.parse_target(fields[0])
+                except ValueError as pe:
+                    cprint("red", "iplist第%d行: %s" % (line_no, str(pe)))
+                    continue
+                if address_range is None:
+                    if fields[0] in seen_names:
+                        target_list.duplicates += 1
+                    else:
+                        seen_names.add(fields[0])
+                        target_list.names.append((fields[0], option_id))
+                    continue
+                if starts and address_range[0] < starts[-1]:
+                    in_order = False
+                starts.append(address_range[0])
+                ends.append(address_range[1])
+                option_ids.append(option_id)
+        # 按工具生成的大文件通常己经有序，只有乱序时才排序
+        order = range(len(starts)) if in_order else sorted(range(len(starts)), key=starts.__getitem__)
+        merged_start, merged_end, merged_id = -1, -2, None
+        duplicates = 0
+        for i in order:
+            start, end, option_id = starts[i], ends[i], option_ids[i]
+            if start <= merged_end:
+                duplicates += min(end, merged_end) - start + 1
+                start = merged_end + 1
+                if start > end:
+                    continue
+            if start == merged_end + 1 and option_id == merged_id:
+                merged_end = end
+                continue
+            if merged_id is not None:
+                target_list.starts.append(merged_start)
+                target_list.ends.append(merged_end)
+                target_list.option_ids.append(merged_id)
+            merged_start, merged_end, merged_id = start, end, option_id
+        if merged_id is not None:
+            target_list.starts.append(merged_start)
+            target_list.ends.append(merged_end)
+            target_list.option_ids.append(merged_id)
+        target_list.duplicates += duplicates
+        return target_list
+
+    def __len__(self):
+        return sum(self.ends) - sum(self.starts) + len(self.starts) + len(self.names)
+
+    def __iter__(self):
+        """
+        :return: 逐个展开的 (ip, options)，同一分组的IP共用同一个options
+        """
+        pack, ntoa = IPV4_ADDRESS.pack, socket.inet_ntoa
+        for start, end, option_id in zip(self.starts, self.ends, self.option_ids):
+            options = self.options[option_id]
+            for address in range(start, end + 1):
+                yield ntoa(pack(address)), options
+        for name, option_id in self.names:
+            yield name, self.options[option_id]
+
+    def ips(self):
+        for ip, options in self:
+            yield ip
+
+    def entries(self):
+        """
+        :return: 逐个展开的 (ip, 选项序号)，顺序与target的序号一致
+        """
+        pack, ntoa = IPV4_ADDRESS.pack, socket.inet_ntoa
+        for start, end, option_id in zip(self.starts, self.ends, self.option_ids):
+            for address in range(start, end + 1):
+                yield ntoa(pack(address)), option_id
+        for name, option_id in self.names:
+            yield name, option_id
+
+    def target(self, index):
+        """
+        按序号取目标，不展开整个列表
+        :return: TUPLE (ip, 选项序号)
+        """
+        offsets = self.offsets()
+        if index >= offsets[-1]:
+            return self.names[index - offsets[-1]]
+        k = bisect.bisect_right(offsets, index) - 1
+        return socket.inet_ntoa(IPV4_ADDRESS.pack(self.starts[k] + index - offsets[k])), self.option_ids[k]
+
+    def index(self, ip):
+        """
+        :return: 目标的序号，不在列表中时返回None
+        """
+        offsets = self.offsets()
+        try:
+            address = IPV4_ADDRESS.unpack(socket.inet_aton(ip))[0] if DnsCache.is_ip_literal(ip) else None
+        except OSError:
+            address = None
+        if address is None:
+            if self._name_index is None:
+                self._name_index = {name: offsets[-1] + i for i, (name, option_id) in enumerate(self.names)}
+            return self._name_index.get(ip)
+        k = bisect.bisect_right(self.starts, address) - 1
+        if k < 0 or address > self.ends[k]:
+            return None
+        return offsets[k] + address - self.starts[k]
+
+    def offsets(self):
+        """
+        :return: array 每个区间之前的地址数，最后一项为地址总数
+        """
+        if self._offsets is None:
+            offsets = array('Q', [0])
+            for start, end in zip(self.starts, self.ends):
+                offsets.append(offsets[-1] + end - start + 1)
+            self._offsets = offsets
+        return self._offsets
+
+    def hostnames(self):
+        return [name for name, option_id in self.names]
+
+
+_target_lists = {}
+_target_lists_lock = threading.Lock()
+
+
+def parse_ip_file(file):
+    """
+    :return: TargetList，iplist的大小和mtime未变化时直接返回上次的解析结果
+    """
+    stat = os.stat(file)
+    version = (stat.st_mtime, stat.st_size)
+    with _target_lists_lock:
+        cached = _target_lists.get(file)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    target_list = TargetList.from_file(file)
+    with _target_lists_lock:
+        _target_lists[file] = (version, target_list)
+    return target_list
+
+
+def shard_of(ip, shards):
+    """
+    :return: INT IP所属的分片，同一IP在各进程、各次运行中固定落在同一分片
+    """
+    return zlib.crc32(ip.encode('utf-8')) % shards
+
+
 def create_ip_list(file):
     try:
         cstart_time = time.time()
-        with open(file, "r") as f_ip_lists:
-            ip_readlines = f_ip_lists.readlines()
-            ip_list = []
-            for ip in ip_readlines:
-                if ip.strip('\n'):
-                    ip_list.append(ip.strip())
-            cend_time = time.time()
-            cprint("blue", "读取文件创建IP列表，耗时： %s秒 " % round((cend_time - cstart_time), 3))
-            return ip_list
+        target_list = parse_ip_file(file)
+        cend_time = time.time()
+        cprint("blue", "读取文件创建IP列表，耗时： %s秒 " % round((cend_time - cstart_time), 3))
+        if target_list.duplicates:
+            cprint("blue", "iplist中有%d个重复的地址，己去重" % target_list.duplicates)
+        return target_list
 
     except Exception as cile:
         cprint("red", "create_ip_list: %s" % str(cile))
         print(traceback.format_exc())
 
 
-class PingThreading(threading.Thread):
-    def __init__(self, ip=None, num=None, r_dir='record'):
-        threading.Thread.__init__(self)
-        self._ip = ip
-        self._thd_num = num
-        self._dir = r_dir
+class ScheduleState(object):
+    def __init__(self, target_list, slots, slot_seconds):
+        """
+        ProbeScheduler的状态快照：TargetList加上各时间槽中目标序号的副本
+        expand()之后按dict的方式使用：ip in state、state[ip]、state.get(ip)、遍历有下一次探测时间的IP
+        """
+        self.target_list = target_list
+        self._slots = slots
+        self._slot_seconds = slot_seconds
+        self._dues = None
 
-    def run(self):
-        with self._thd_num:
-            print("IP:%s，开始子线程：%s" % (self._ip, threading.current_thread().ident))
-            ops = CheckIp(record_dir=self._dir)
-            ops.run_ping(ip=self._ip)
-            print("IP:%s，等待子线程：%s 执行完毕" % (self._ip, threading.current_thread().ident))
+    def expand(self):
+        """
+        按序号展开为每个目标一个float的数组，不为每个目标创建字符串
+        """
+        dues = array('d', [math.nan]) * len(self.target_list)
+        for slot, bucket in self._slots:
+            due = slot * self._slot_seconds
+            for index in bucket:
+                dues[index] = due
+        self._dues = dues
+        self._slots = None
+        return self
+
+    def get(self, ip, default=None):
+        index = self.target_list.index(ip)
+        if index is None or math.isnan(self._dues[index]):
+            return default
+        return self._dues[index]
+
+    def __contains__(self, ip):
+        return self.get(ip) is not None
+
+    def __getitem__(self, ip):
+        due = self.get(ip)
+        if due is None:
+            raise KeyError(ip)
+        return due
+
+    def __iter__(self):
+        dues = self._dues
+        for index, (ip, option_id) in enumerate(self.target_list.entries()):
+            if not math.isnan(dues[index]):
+                yield ip
+
+
+class ProbeScheduler(object):
+    SLOT = 0.1
+
+    def __init__(self, interval=DEFAULT_SCHEDULE_INTERVAL, jitter=DEFAULT_SCHEDULE_JITTER):
+        """
+        持续监测模式的调度器：每个目标按自己的间隔定时探测，不再按轮等待最慢的IP
+        目标按到期时间放入SLOT秒一格的时间槽，槽内只保存目标在TargetList中的序号，百万级目标也只占几MB
+        目标到期时上一次探测仍未完成则记为超期并跳过本次，不会堆积
+        :param interval: 默认探测间隔，单位秒，可由iplist中的interval选项覆盖
+        :param jitter: 间隔的随机抖动比例，避免探测集中在同一时刻
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.count = 0
+        self._targets = None
+        self._intervals = []
+        self._slots = {}
+        self._slot_heap = []
+        self._running = {}
+        self._restored = {}
+        self._lock = threading.Lock()
+        self.dispatched = 0
+        self.started = 0
+        self.overdue = 0
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+
+    def target_interval(self, options):
+        try:
+            return max(float(options.get('interval', self.interval)), 0.1)
+        except ValueError:
+            cprint("red", "interval选项[%s]有误，使用默认间隔%s秒" % (options.get('interval'), self.interval))
+            return self.interval
+
+    def apply_settings(self, settings):
+        """
+        config中的默认间隔变化时重新计算各分组的间隔，己排好的下一次探测不变，之后按新间隔调度
+        """
+        with self._lock:
+            self.jitter = settings.schedule_jitter
+            if settings.schedule_interval == self.interval:
+                return
+            self.interval = settings.schedule_interval
+            if self._targets is not None:
+                self._intervals = [self.target_interval(options) for options in self._targets.options]
+
+    def _slot(self, due):
+        # 向上取整，目标不会早于到期时间被探测
+        return int(math.ceil(due / self.SLOT))
+
+    def _snapshot(self):
+        """
+        只复制各时间槽的序号数组，调用方持有锁
+        """
+        return ScheduleState(self._targets, [(slot, bucket[:]) for slot, bucket in self._slots.items()], self.SLOT)
+
+    def load(self, target_list, include=None):
+        """
+        同步目标列表：新目标随机分布在一个间隔内开始，己删除的目标不再调度，己有目标保持原有节奏
+        :param target_list: TargetList
+        :param include: 判断IP是否属于本进程的函数，None为全部目标
+        :return: INT 目标数
+        """
+        now = time.time()
+        with self._lock:
+            # 只有iplist变化时才会重新加载，此时按IP保留原有目标的到期时间
+            previous = self._snapshot().expand() if self._targets is not None else {}
+            intervals = [self.target_interval(options) for options in target_list.options]
+            slots = {}
+            count = 0
+            for index, (ip, option_id) in enumerate(target_list.entries()):
+                if include is not None and not include(ip):
+                    continue
+                count += 1
+                interval = intervals[option_id]
+                due = previous.get(ip)
+                if due is None:
+                    # 从检查点恢复的目标保持原有节奏，己过期的与新目标一样随机分布在一个间隔内
+                    due = self._restored.pop(ip, None)
+                    if due is None or not now <= due <= now + interval:
+                        due = now + random.uniform(0, interval)
+                slot = self._slot(due)
+                bucket = slots.get(slot)
+                if bucket is None:
+                    bucket = slots[slot] = array('I')
+                bucket.append(index)
+            self._targets = target_list
+            self._intervals = intervals
+            self._slots = slots
+            self._slot_heap = list(slots)
+            heapq.heapify(self._slot_heap)
+            self.count = count
+        return count
+
+    def state(self):
+        """
+        :return: ScheduleState 各目标下一次探测的时间，用于写入检查点；锁内只复制序号数组，不阻塞调度
+        """
+        with self._lock:
+            if self._targets is None:
+                return {}
+            snapshot = self._snapshot()
+        return snapshot.expand()
+
+    def restore(self, dues):
+        """
+        :param dues: 检查点中各目标下一次探测的时间，在之后load目标时生效
+        """
+        with self._lock:
+            self._restored = dict(dues)
+
+    def _next_due(self, due, interval, now):
+        next_due = due + interval * (1 + random.uniform(-self.jitter, self.jitter))
+        if next_due < now:
+            # 严重落后时不补发，从现在起重新计时
+            next_due = now + random.uniform(0, interval)
+        return next_due
+
+    def pop_due(self, now):
+        """
+        :return: LIST 己到期、可以开始探测的 (ip, 到期时间)，调用方在开始探测时调用mark_started，结束后调用mark_done
+        """
+        due_ips = []
+        with self._lock:
+            target = self._targets.target if self._targets is not None else None
+            while self._slot_heap and self._slot_heap[0] * self.SLOT <= now:
+                slot = heapq.heappop(self._slot_heap)
+                due = slot * self.SLOT
+                for index in self._slots.pop(slot):
+                    ip, option_id = target(index)
+                    # 下一次至少落在后面的槽中，避免同一轮内重复出队
+                    next_slot = max(self._slot(self._next_due(due, self._intervals[option_id], now)), slot + 1)
+                    bucket = self._slots.get(next_slot)
+                    if bucket is None:
+                        bucket = self._slots[next_slot] = array('I')
+                        heapq.heappush(self._slot_heap, next_slot)
+                    bucket.append(index)
+                    if ip in self._running:
+                        self.overdue += 1
+                        SCHEDULER_OVERDUE.inc()
+                        continue
+                    TARGETS_RUNNING.inc()
+                    self.dispatched += 1
+                    self._running[ip] = index
+                    due_ips.append((ip, due))
+        return due_ips
+
+    def mark_started(self, due):
+        """
+        探测真正开始时记录调度延迟，包括在工作队列中等待空闲工作线程的时间
+        """
+        lag = max(time.time() - due, 0.0)
+        SCHEDULER_LAG_SECONDS.observe(lag)
+        with self._lock:
+            self.started += 1
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_sum += lag
+
+    def mark_done(self, ip):
+        with self._lock:
+            if self._running.pop(ip, None) is not None:
+                TARGETS_RUNNING.dec()
+
+    def running(self):
+        with self._lock:
+            return len(self._running)
+
+    def next_wakeup(self):
+        with self._lock:
+            return self._slot_heap[0] * self.SLOT if self._slot_heap else None
+
+    def stats_message(self):
+        with self._lock:
+            lag_avg = self.lag_sum / self.started if self.started else 0.0
+            return "调度：目标%d个，执行中%d个，己调度%d次，超期跳过%d次，调度延迟平均%.3f秒/最大%.3f秒" % (
+                self.count, len(self._running), self.dispatched, self.overdue, lag_avg, self.lag_max)
 
 
 class MainThreading(threading.Thread):
-    def __init__(self, thd_num, timeout=None, record_dir='record', ip_file=DEFAULT_IP_FILE):
+    def __init__(self, thd_num, timeout=None, record_dir='record', ip_file=DEFAULT_IP_FILE, settings_watcher=None,
+                 workers=32, shard=None, checkpoint=None):
+        """
+        :param thd_num: threading.Semaphore 并发线程数
+        :param workers: INT 持续监测模式下的工作线程数
+        :param shard: TUPLE (分片序号, 分片数)，多进程模式下只检测属于本分片的IP，记录目录由父进程创建
+        :param checkpoint: Checkpoint，--resume时继续写入己有的记录目录，持续监测模式下各目标保持检查点中的节奏
+        """
         threading.Thread.__init__(self)
-        self.csv_headers = ['Time', 'IP', 'Sent', 'Rcvd', 'Loss']
+        self.workers = workers
+        self.shard = shard
+        self.checkpoint = checkpoint
+        self.settings_watcher = settings_watcher if settings_watcher is not None else get_settings_watcher()
+        self.csv_headers = RECORD_CSV_HEADERS
         self.time_stramp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
         self.thd_num = thd_num
         self.timeout = timeout
         self.record_dir = record_dir
         self.ip_file = ip_file
-        os.mkdir(self.record_dir)
+        if shard is None and checkpoint is None:
+            os.mkdir(self.record_dir)
+
+    def in_shard(self, ip):
+        return self.shard is None or shard_of(ip, self.shard[1]) == self.shard[0]
+
+    def load_ip_list(self):
+        """
+        :return: TUPLE (目标数, 本分片IP的迭代器)，按需展开，不生成完整的IP列表
+        """
+        target_list = create_ip_list(self.ip_file)
+        get_dns_cache().prefetch(target_list.hostnames())
+        if self.shard is None:
+            return len(target_list), target_list.ips()
+        return len(target_list), (ip for ip in target_list.ips() if self.in_shard(ip))
+
+    def run_round(self, ip_iter, settings):
+        """
+        固定数量的工作线程从同一个迭代器中取IP，不再为每个IP创建线程
+        """
+        ip_lock = threading.Lock()
+
+        def worker():
+            while not shutdown_requested():
+                with ip_lock:
+                    ip = next(ip_iter, None)
+                if ip is None:
+                    return
+                with self.thd_num:
+                    log.debug("IP:%s，开始探测：%s", ip, threading.current_thread().name)
+                    CheckIp(record_dir=self.record_dir, settings=settings).run_ping(ip=ip)
+
+        threads = [threading.Thread(target=worker, name='round-worker-%d' % i) for i in range(max(1, self.workers))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def write_csv_header(self):
+        # 表头由记录目录的ResultSink在创建时写入
+        get_result_sink(self.record_dir)
 
     def run(self):
         try:
-            with open(os.path.join(self.record_dir, 'check-ip-record.csv'), 'a+') as f_csv:
-                csv_ops = csv.writer(f_csv)
-                csv_ops.writerow(self.csv_headers)
-            f_csv.close()
+            self.write_csv_header()
 
             if self.timeout is None:
-                count = 1
-                threads = [PingThreading(ip=ip, num=self.thd_num, r_dir=self.record_dir) for ip in create_ip_list(self.ip_file)]
-                cprint("green", "主线程总计[%d]个任务" % len(threads))
-                for t in threads:
-                    t.start()
-                for t in threads:
-                    t.join()
-                    print('第%d个线程完成...' % count)
-                    count += 1
+                settings = self.settings_watcher.refresh()
+                count, ip_iter = self.load_ip_list()
+                cprint("green", "主线程总计[%d]个目标" % count)
+                self.run_round(ip_iter, settings)
+            elif self.settings_watcher.refresh().schedule_continuous:
+                self.run_continuous()
             else:
                 r_count = 1
-                while True:
+                while not shutdown_requested():
                     cprint("red", '开始第%d次循环...' % r_count)
-                    threads = [PingThreading(ip=ip, num=self.thd_num, r_dir=self.record_dir) for ip in create_ip_list(self.ip_file)]
-                    cprint("green", "主线程总计[%d]个任务" % len(threads))
-                    for t in threads:
-                        t.start()
-                    count = 1
-                    for t in threads:
-                        t.join()
-                        print('第%d个线程完成...' % count)
-                        count += 1
+                    # 每轮开始前检查config是否变化，本轮内所有IP使用同一份配置
+                    settings = self.settings_watcher.refresh()
+                    count, ip_iter = self.load_ip_list()
+                    cprint("green", "主线程总计[%d]个目标" % count)
+                    self.run_round(ip_iter, settings)
                     r_count += 1
                     time.sleep(1)
 
@@ -453,9 +3507,317 @@ class MainThreading(threading.Thread):
             cprint("red", str(e))
             print(traceback.format_exc())
 
+    def reload_targets(self, scheduler, ip_mtime):
+        """
+        iplist有变化时重新加载目标
+        :return: iplist当前的mtime
+        """
+        try:
+            mtime = os.stat(self.ip_file).st_mtime
+            if mtime != ip_mtime:
+                target_list = parse_ip_file(self.ip_file)
+                get_dns_cache().prefetch(target_list.hostnames())
+                include = self.in_shard if self.shard is not None else None
+                cprint("green", "加载iplist，总计[%d]个目标" % scheduler.load(target_list, include))
+            return mtime
+        except Exception as le:
+            cprint("red", "reload_targets: %s" % str(le))
+            print(traceback.format_exc())
+            return ip_mtime
+
+    def run_continuous(self):
+        """
+        持续监测模式：调度器按各目标的间隔把到期IP交给固定数量的工作线程
+        """
+        settings = self.settings_watcher.refresh()
+        scheduler = self.create_scheduler(settings)
+        work_queue = queue.Queue()
+        state = {'settings': settings}
+
+        def worker():
+            while True:
+                ip, due = work_queue.get()
+                scheduler.mark_started(due)
+                try:
+                    # 停止后队列中剩余的目标不再探测
+                    if not shutdown_requested():
+                        CheckIp(record_dir=self.record_dir, settings=state['settings']).run_ping(ip)
+                finally:
+                    scheduler.mark_done(ip)
+
+        for i in range(max(1, self.workers)):
+            t = threading.Thread(target=worker, name='probe-worker-%d' % i)
+            t.daemon = True
+            t.start()
+        cprint("green", "持续监测模式，工作线程[%d]个" % self.workers)
+        ip_mtime = None
+        next_reload = next_report = 0
+        while not shutdown_requested():
+            now = time.time()
+            if now >= next_reload:
+                state['settings'] = settings = self.settings_watcher.refresh()
+                scheduler.apply_settings(settings)
+                ip_mtime = self.reload_targets(scheduler, ip_mtime)
+                next_reload = now + DEFAULT_SCHEDULE_RELOAD
+            if now >= next_report:
+                if next_report:
+                    cprint("green", scheduler.stats_message())
+                next_report = now + 60
+            for ip, due in scheduler.pop_due(now):
+                work_queue.put((ip, due))
+            wakeup = scheduler.next_wakeup()
+            time.sleep(min(max(wakeup - time.time(), 0.001), 0.5) if wakeup is not None else 0.5)
+        while scheduler.running():
+            time.sleep(0.1)
+
+    def create_scheduler(self, settings):
+        """
+        :return: ProbeScheduler，其状态随记录目录的检查点保存，--resume时各目标保持检查点中的节奏
+        """
+        scheduler = ProbeScheduler(settings.schedule_interval, settings.schedule_jitter)
+        if self.checkpoint is not None:
+            scheduler.restore(self.checkpoint.dues)
+        get_result_sink(self.record_dir).scheduler = scheduler
+        return scheduler
+
+
+class AsyncMainThreading(MainThreading):
+    def __init__(self, thd_num, timeout=None, record_dir='record', ip_file=DEFAULT_IP_FILE, settings_watcher=None,
+                 shard=None, checkpoint=None):
+        """
+        asyncio模式：在本线程的事件循环中以协程执行所有IP，不再为每个IP创建线程
+        :param thd_num: INT 在途探测数上限，同时也是并发处理的IP数
+        """
+        MainThreading.__init__(self, thd_num, timeout=timeout, record_dir=record_dir, ip_file=ip_file,
+                               settings_watcher=settings_watcher, shard=shard, checkpoint=checkpoint)
+
+    def run(self):
+        try:
+            self.write_csv_header()
+            asyncio.run(self.run_async())
+        except Exception as e:
+            cprint("red", str(e))
+            print(traceback.format_exc())
+
+    async def run_round_async(self, ip_iter, limiter, settings):
+        """
+        固定数量的worker协程从同一个迭代器中取IP，避免一次性为所有IP创建任务
+        """
+        async def worker():
+            for ip in ip_iter:
+                if shutdown_requested():
+                    return
+                await CheckIp(record_dir=self.record_dir, settings=settings).run_ping_async(ip, limiter)
+
+        await asyncio.gather(*[worker() for _ in range(max(1, self.thd_num))])
+
+    async def run_continuous_async(self, limiter):
+        """
+        持续监测模式的asyncio版本，同时执行的IP数不超过thd_num
+        """
+        settings = self.settings_watcher.refresh()
+        scheduler = self.create_scheduler(settings)
+        slots = asyncio.Semaphore(self.thd_num)
+        loop = asyncio.get_event_loop()
+
+        async def probe(ip, settings):
+            try:
+                await CheckIp(record_dir=self.record_dir, settings=settings).run_ping_async(ip, limiter)
+            finally:
+                scheduler.mark_done(ip)
+                slots.release()
+
+        cprint("green", "持续监测模式，同时执行的IP数[%d]" % self.thd_num)
+        ip_mtime = None
+        next_reload = next_report = 0
+        while not shutdown_requested():
+            now = time.time()
+            if now >= next_reload:
+                settings = self.settings_watcher.refresh()
+                scheduler.apply_settings(settings)
+                ip_mtime = await loop.run_in_executor(None, self.reload_targets, scheduler, ip_mtime)
+                next_reload = now + DEFAULT_SCHEDULE_RELOAD
+            if now >= next_report:
+                if next_report:
+                    cprint("green", scheduler.stats_message())
+                next_report = now + 60
+            for ip, due in scheduler.pop_due(now):
+                await slots.acquire()
+                scheduler.mark_started(due)
+                asyncio.ensure_future(probe(ip, settings))
+            wakeup = scheduler.next_wakeup()
+            await asyncio.sleep(min(max(wakeup - time.time(), 0.001), 0.5) if wakeup is not None else 0.5)
+        while scheduler.running():
+            await asyncio.sleep(0.1)
+
+    async def run_async(self):
+        limiter = asyncio.Semaphore(self.thd_num)
+        get_icmp_engine(loop=asyncio.get_event_loop())
+        try:
+            if self.timeout is not None and self.settings_watcher.refresh().schedule_continuous:
+                await self.run_continuous_async(limiter)
+                return
+            r_count = 1
+            while not shutdown_requested():
+                if self.timeout is not None:
+                    cprint("red", '开始第%d次循环...' % r_count)
+                settings = self.settings_watcher.refresh()
+                count, ip_iter = await asyncio.get_event_loop().run_in_executor(None, self.load_ip_list)
+                cprint("green", "主协程总计[%d]个目标" % count)
+                await self.run_round_async(ip_iter, limiter, settings)
+                if self.timeout is None:
+                    break
+                r_count += 1
+                await asyncio.sleep(1)
+        finally:
+            await self.wait_traces()
+
+    async def wait_traces(self):
+        """
+        内置路径追踪的回包由本线程的事件循环接收，事件循环结束前等待己排队的追踪执行完毕
+        收到停止请求时只等待到停止期限；之后改由接收线程读取回包，仍未完成的追踪不会因事件循环关闭而收不到回包
+        """
+        timeout = shutdown_remaining() if shutdown_requested() else get_settings().mtr_timeout
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, wait_mtr_dispatchers, timeout)
+        finally:
+            get_icmp_engine().detach_loop()
+
+
+def wait_main_thread(run, timeout=None, stop=None, grace=0.0):
+    """
+    等待主线程：运行时长到期、收到Ctrl+C或父进程的停止通知后不再开始新的探测，在途探测在停止期限内完成
+    :param timeout: 运行时长，None为等待主线程自行结束
+    :param stop: multiprocessing.Value，多进程模式下父进程写入的停止期限(time.time())，0为未停止
+    :param grace: 停止期限之外额外等待的秒数
+    :return: BOOL 是否因停止请求而结束
+    """
+    end = None if timeout is None else time.time() + timeout
+    interrupted = False
+    while run.is_alive():
+        if stop is not None and stop.value:
+            request_shutdown(max(0.0, stop.value - time.time()))
+        if shutdown_requested():
+            interrupted = True
+            break
+        if end is not None and time.time() >= end:
+            break
+        run.join(0.2)
+    request_shutdown(get_settings().shutdown_timeout)
+    run.join(shutdown_remaining() + grace)
+    if run.is_alive():
+        cprint("red", "等待在途探测超时，未完成的探测己放弃")
+    return interrupted
+
+
+def run_shard(shard, shards, ident_base, thd_num, timeout, record_dir, ip_file, use_async, results, verbosity=0,
+              stop=None):
+    """
+    多进程模式下子进程的入口：只检测本分片的IP，使用独立的ICMP socket和标识符范围，结果交给父进程写入
+    指标快照每METRICS_SHARD_INTERVAL秒交给父进程一次
+    子进程忽略Ctrl+C，由父进程通过stop通知停止期限
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(verbosity)
+
+    def report_metrics():
+        while True:
+            time.sleep(METRICS_SHARD_INTERVAL)
+            results.put(('metrics', shard, metrics.snapshot()))
+
+    reporter = threading.Thread(target=report_metrics, name='metrics-reporter')
+    reporter.daemon = True
+    reporter.start()
+    try:
+        set_icmp_ident_base(ident_base)
+        set_result_sink(record_dir, ShardSink(results))
+        watcher = get_settings_watcher()
+        if use_async:
+            run = AsyncMainThreading(thd_num=thd_num, timeout=timeout, record_dir=record_dir, ip_file=ip_file,
+                                     settings_watcher=watcher, shard=(shard, shards))
+        else:
+            run = MainThreading(thd_num=threading.Semaphore(thd_num), timeout=timeout, record_dir=record_dir,
+                                ip_file=ip_file, settings_watcher=watcher, workers=thd_num, shard=(shard, shards))
+        run.daemon = True
+        run.start()
+        interrupted = wait_main_thread(run, timeout, stop=stop)
+        wait_mtr_dispatchers(shutdown_remaining() if interrupted else get_settings().mtr_timeout)
+    except Exception as se:
+        cprint("red", "run_shard: %s" % str(se))
+        print(traceback.format_exc())
+    finally:
+        results.put(('metrics', shard, metrics.snapshot()))
+        results.put(('done', shard))
+
+
+class ShardedMainThreading(threading.Thread):
+    def __init__(self, processes, thd_num, timeout=None, record_dir='record', ip_file=DEFAULT_IP_FILE,
+                 use_async=False, verbosity=0, checkpoint=None):
+        """
+        多进程模式：按IP哈希把iplist分给多个子进程，每个子进程有自己的ICMP socket和标识符范围，
+        本线程接收子进程的结果，统一写入记录目录
+        :param processes: INT 子进程数
+        :param thd_num: INT 每个子进程的并发数
+        :param checkpoint: Checkpoint，--resume时继续写入己有的记录目录
+        """
+        threading.Thread.__init__(self)
+        self.processes = processes
+        self.thd_num = thd_num
+        self.timeout = timeout
+        self.record_dir = record_dir
+        self.ip_file = ip_file
+        self.use_async = use_async
+        self.verbosity = verbosity
+        if checkpoint is None:
+            os.mkdir(self.record_dir)
+
+    def run(self):
+        try:
+            sink = get_result_sink(self.record_dir)
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            stop = context.Value('d', 0.0)
+            ident_base = os.getpid()
+            workers = []
+            for shard in range(self.processes):
+                worker = context.Process(target=run_shard, name='check-ip-shard-%d' % shard, args=(
+                    shard, self.processes, (ident_base + shard * DEFAULT_IDENT_COUNT) & 0xFFFF, self.thd_num,
+                    self.timeout, self.record_dir, self.ip_file, self.use_async, results, self.verbosity, stop))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            cprint("green", "多进程模式，子进程[%d]个" % self.processes)
+            done = 0
+            while done < self.processes:
+                if shutdown_requested() and not stop.value:
+                    stop.value = time.time() + shutdown_remaining()
+                try:
+                    message = results.get(timeout=0.2)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        cprint("red", "子进程己全部退出，%d个子进程未正常结束" % (self.processes - done))
+                        break
+                    continue
+                kind = message[0]
+                if kind == 'ping':
+                    sink.put_ping(message[1], message[2])
+                elif kind == 'mtr':
+                    sink.put_mtr(message[1])
+                elif kind == 'hops':
+                    sink.put_hops(message[1], message[2], message[3])
+                elif kind == 'metrics':
+                    metrics.merge_remote(message[1], message[2])
+                elif kind == 'done':
+                    done += 1
+            for worker in workers:
+                worker.join(timeout=1)
+        except Exception as e:
+            cprint("red", str(e))
+            print(traceback.format_exc())
+
 
 if __name__ == '__main__':
-    config_file = os.path.join(run_path(), 'config')
+    config_file = DEFAULT_CONFIG_FILE
     if os.path.exists(config_file) and os.path.isfile(config_file):
         pass
     else:
@@ -468,24 +3830,96 @@ count = 5
 wait = 200
 #每次ping的超时时间，单位秒
 timeout = 1
+#流水线模式：1=按wait间隔连续发出所有探测，不等待上一个回包；0=逐个发送，收到回包后再等待wait
+pipeline = 0
+#ICMP数据部分长度，单位字节(含8字节时间戳)
+size = 192
+#自适应探测：1=按每个IP最近的结果决定探测次数，0=每次都发count个
+adaptive = 0
+#连续多少次无丢包后视为健康
+healthy_rounds = 10
+#健康的IP每次只发几个探测，出现丢包时立即补发count个
+healthy_count = 1
+#上一次有丢包的IP发几个探测
+lossy_count = 10
 
 [mtr]
 #mtr程序所在路径，可以是绝对路径、相对路径
 path = mtr
 #mtr的参数，按实际在cmd或shell中运行时指定的写进去即可，每个参数用空格分隔
 paras = -c 3 -r --no-dns
+#同时执行的mtr数，mtr在单独的队列中执行，不占用ping的并发
+workers = 4
+#单次mtr的超时时间，单位秒
+timeout = 60
+#同一IP两次mtr的最小间隔，单位秒
+cooldown = 300
+#大于0时按该前缀长度合并网段，例如24表示同一个/24网段在冷却时间内只执行一次mtr，0为不合并
+collapse_prefix = 0
+#mtr队列长度，队列满时不再执行新的mtr
+queue_size = 1000
+#路径追踪方式：native=内置追踪(共用ICMP socket，并行探测所有跳，逐跳结果写入mtr-hop-record.csv)；external=执行外部mtr程序
+engine = external
+#内置追踪的最大跳数
+max_hops = 30
+#内置追踪每跳的探测次数
+probes = 3
+#内置追踪同时追踪的IP数
+native_workers = 128
+
+[dns]
+#域名解析结果的缓存时间，单位秒，后台线程会在过期后刷新
+ttl = 300
+#域名解析失败的缓存时间，单位秒
+negative_ttl = 30
+
+[record]
+#记录由单独的写线程批量写盘：积累多少条记录写一次
+batch_size = 500
+#距上次写盘超过多少秒写一次
+flush_interval = 1
+#ping记录格式：csv=check-ip-record.csv；binary=目录下store中的定长二进制分段记录，可用--query查询、--export导出为csv；both=两者都写
+format = csv
+#二进制记录每段行数，写满后按IP排序并生成索引
+segment_rows = 200000
+#每隔多少秒把各IP的汇总、自适应探测和调度状态写入记录目录下的checkpoint，--resume时从检查点恢复，0=不写
+checkpoint_interval = 60
+#Ctrl+C后等待在途探测和mtr完成的最长时间，单位秒，超时未完成的放弃
+shutdown_timeout = 10
+
+[schedule]
+#指定-t时的运行方式：1=持续监测，每个IP按自己的间隔定时探测；0=按轮检测，每轮等所有IP完成后再开始下一轮
+continuous = 0
+#持续监测时每个IP的探测间隔，单位秒，iplist中可用 interval=N 按IP或分组覆盖
+interval = 10
+#探测间隔的随机抖动比例，0.1表示±10%
+jitter = 0.1
+
+[metrics]
+#Prometheus指标采集端口，0=不启动
+port = 0
+#采集端口监听的地址
+bind = 127.0.0.1
+#每隔多少秒把指标快照写入记录目录下的metrics.json，0=不写
+snapshot_interval = 10
 """)
+    get_settings_watcher()
     start_time = time.time()
     thd_num = 32
     summary = False
     run_time = None
+    use_async = False
+    processes = 0
+    verbosity = 0
+    query_dir = export_dir = query_ip = query_from = query_to = resume_dir = None
     ip_file = os.path.join(run_path(), 'iplist')
     argv = sys.argv[1:]
     time_stramp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
     record_dir = os.path.join(run_path(), time_stramp)
 
     try:
-        opts, args = getopt(argv, "hn:t:s")
+        opts, args = getopt(argv, "hn:t:sp:v", ["async", "query=", "export=", "ip=", "from=", "to=",
+                                               "resume="])
     except GetoptError:
         cprint("green", """
     在iplist文件中写入需要检测的IP地址，每行一个
@@ -495,6 +3929,12 @@ paras = -c 3 -r --no-dns
     -n <number> 指定线程并发数，单位数字。
     -t <number> 指定运行时间，单位秒。不指定-t，只执行一次。（指定运行时间会在指定时间内循环对iplist列表做检测）
     -s 是否对IP ping的数据进行统计，主要统计每个IP总体的发送包、接收包，丢包率情况
+    --async 使用asyncio协程模式执行，-n 指定的是在途探测数上限，适合大量IP
+    -p <number> 多进程模式，按IP把iplist分给指定数量的子进程，-n 为每个子进程的并发数，结果统一写入同一目录
+    -v 输出每个IP的检测过程日志，-vv 输出更详细的各步骤耗时
+    --query <目录> [--ip <IP>] [--from <时间>] [--to <时间>] 查询二进制记录中IP在时间段内的丢包率，时间格式 "YYYY-mm-dd HH:MM:SS"
+    --export <目录> [--ip <IP>] [--from <时间>] [--to <时间>] 把二进制记录导出为目录下的check-ip-record-export.csv
+    --resume <目录> 继续写入己有的记录目录：从目录下的checkpoint恢复汇总和调度状态，只读取检查点之后写入的记录
     """)
         sys.exit(1)
     except Exception as e:
@@ -512,6 +3952,12 @@ config文件是配置文件，里面有一些配置参数，可自行定义。
 -n <number> 指定线程并发数，单位数字。
 -t <number> 指定运行时间，单位秒。不指定-t，只执行一次。（指定运行时间会在指定时间内循环对iplist列表做检测）
 -s 是否对IP ping的数据进行统计，主要统计每个IP总体的发送包、接收包，丢包率情况
+--async 使用asyncio协程模式执行，-n 指定的是在途探测数上限，适合大量IP
+-p <number> 多进程模式，按IP把iplist分给指定数量的子进程，-n 为每个子进程的并发数，结果统一写入同一目录
+-v 输出每个IP的检测过程日志，-vv 输出更详细的各步骤耗时
+--query <目录> [--ip <IP>] [--from <时间>] [--to <时间>] 查询二进制记录中IP在时间段内的丢包率，时间格式 "YYYY-mm-dd HH:MM:SS"
+--export <目录> [--ip <IP>] [--from <时间>] [--to <时间>] 把二进制记录导出为目录下的check-ip-record-export.csv
+--resume <目录> 继续写入己有的记录目录：从目录下的checkpoint恢复汇总和调度状态，只读取检查点之后写入的记录
 """)
             sys.exit()
         elif opt in ('-n',):
@@ -520,6 +3966,68 @@ config文件是配置文件，里面有一些配置参数，可自行定义。
             summary = True
         elif opt in ('-t',):
             run_time = int(arg)
+        elif opt in ('--async',):
+            use_async = True
+        elif opt in ('-p',):
+            processes = int(arg)
+        elif opt in ('--query',):
+            query_dir = arg
+        elif opt in ('--export',):
+            export_dir = arg
+        elif opt in ('--ip',):
+            query_ip = arg
+        elif opt in ('--from',):
+            query_from = arg
+        elif opt in ('--to',):
+            query_to = arg
+        elif opt in ('-v',):
+            verbosity += 1
+        elif opt in ('--resume',):
+            resume_dir = os.path.abspath(arg)
+    setup_logging(verbosity)
+
+    if query_dir or export_dir:
+        try:
+            start, end = parse_record_time(query_from), parse_record_time(query_to)
+            if query_dir:
+                reader = SegmentReader(os.path.join(query_dir, 'store'))
+                if query_ip:
+                    sent, rcvd, loss = reader.loss(query_ip, start, end)
+                    cprint("green", "IP: %s, Sent: %d, Rcvd: %d, Loss: %.2f%%" % (query_ip, sent, rcvd, loss))
+                else:
+                    aggregator = ResultAggregator()
+                    aggregator.add_rows(RECORD_CSV_HEADERS, reader.csv_rows(None, start, end))
+                    for row in aggregator.rows():
+                        print(','.join(str(field) for field in row[:4]))
+            if export_dir:
+                export_file = os.path.join(export_dir, 'check-ip-record-export.csv')
+                count = SegmentReader(os.path.join(export_dir, 'store')).export_csv(export_file, query_ip, start, end)
+                cprint("green", "己导出%d行到[%s]" % (count, export_file))
+        except Exception as qe:
+            cprint("red", '异常: %s' % str(qe))
+            sys.exit(1)
+        sys.exit(0)
+
+    checkpoint = None
+    if resume_dir:
+        if not os.path.isdir(resume_dir):
+            cprint("red", "记录目录[%s]不存在" % resume_dir)
+            sys.exit(1)
+        record_dir = resume_dir
+        resume_start = time.time()
+        settings = get_settings()
+        if settings.record_format != 'binary':
+            trim_record_file(os.path.join(record_dir, 'check-ip-record.csv'))
+        checkpoint = load_checkpoint(record_dir, settings.record_format)
+        set_result_aggregator(record_dir, checkpoint.aggregator)
+        get_probe_policy().restore(checkpoint.policy)
+        if checkpoint.created is not None:
+            cprint("green", "从检查点(%s)恢复：目标%d个，检查点之后的记录%d行，耗时： %s秒" % (
+                datetime.datetime.fromtimestamp(checkpoint.created).strftime('%Y-%m-%d %H:%M:%S'),
+                len(checkpoint.aggregator), checkpoint.tail_rows, round(time.time() - resume_start, 3)))
+        else:
+            cprint("green", "记录目录中没有检查点，己读取全部记录：目标%d个，耗时： %s秒" % (
+                len(checkpoint.aggregator), round(time.time() - resume_start, 3)))
 
     num = threading.Semaphore(thd_num)
     if run_time is not None:
@@ -527,18 +4035,32 @@ config文件是配置文件，里面有一些配置参数，可自行定义。
     signal.signal(signal.SIGINT, signal_handler)
     if hasattr(signal, "SIGBREAK"):
         signal.signal(signal.SIGBREAK, signal_handler)
-    run = MainThreading(thd_num=num, timeout=run_time, record_dir=record_dir)
+    if processes > 0:
+        run = ShardedMainThreading(processes, thd_num, timeout=run_time, record_dir=record_dir, ip_file=ip_file,
+                                   use_async=use_async, verbosity=verbosity, checkpoint=checkpoint)
+    elif use_async:
+        run = AsyncMainThreading(thd_num=thd_num, timeout=run_time, record_dir=record_dir, checkpoint=checkpoint)
+    else:
+        run = MainThreading(thd_num=num, timeout=run_time, record_dir=record_dir, workers=thd_num,
+                            checkpoint=checkpoint)
+    start_metrics(get_settings(), record_dir)
     cprint("blue", "主线程开始: ")
-    cprint("blue", "可使用Ctrl+C随时终止任务 ")
-    cprint("blue", "当前线程数: %s" % thd_num)
-    run.setDaemon(True)
+    cprint("blue", "可使用Ctrl+C随时终止任务，再次Ctrl+C立即退出 ")
+    cprint("blue", "当前%s数: %s" % ("在途探测" if use_async else "线程", thd_num))
+    run.daemon = True
     run.start()
-    run.join(timeout=run_time)
+    # 多进程模式下子进程自己控制运行时长，并在退出前等待各自的mtr执行完毕
+    interrupted = wait_main_thread(run, timeout=None if processes > 0 else run_time, grace=1.0 if processes > 0 else 0.0)
     cprint("green", "所有任务己完成...")
-    run.isAlive()
+    # Ctrl+C后mtr和写盘都只在停止期限内等待，关闭写队列时写入最后一个检查点
+    wait_mtr_dispatchers(shutdown_remaining() if interrupted else get_settings().mtr_timeout)
+    complete = close_result_sinks(shutdown_remaining() if interrupted else None)
     cprint("blue", "主线程结束...\n")
 
-    if summary:
+    if summary and not complete:
+        # 汇总在记录出队时就己累加，写盘未完成时汇总会包含记录文件中没有的数据
+        cprint("red", "部分记录未能写入记录文件，跳过汇总")
+    elif summary:
         cprint("blue", "开始汇总数据: ")
         CheckIp(record_dir=record_dir).sum_check_result()
         cprint("blue", "汇总数据完成...")
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# @FileName：     test_dns_cache.py
+
+"""
+DnsCache：预解析、过期刷新，探测路径上不阻塞在解析器上
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from check_ip import DnsCache  # noqa: E402
+
+
+class DnsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache(ttl=1, negative_ttl=1, workers=2)
+        self.resolved = []
+        resolve = self.cache.resolve
+
+        def counting_resolve(host):
+            self.resolved.append(host)
+            return resolve(host)
+
+        self.cache.resolve = counting_resolve
+
+    def call(self, func, *args):
+        """
+        在子线程中调用，超时则认为己死锁
+        """
+        result = {}
+
+        def target():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive(), "%s 没有返回" % func.__name__)
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def test_prefetch_then_lookup(self):
+        self.call(self.cache.prefetch, ['localhost', '127.0.0.1'])
+        self.assertEqual(self.call(self.cache.lookup, 'localhost'), '127.0.0.1')
+        self.assertEqual(self.call(self.cache.lookup, '10.0.0.1'), '10.0.0.1')
+        self.assertEqual(self.resolved, ['localhost'])
+
+    def test_expired_entries_are_refreshed(self):
+        self.call(self.cache.prefetch, ['localhost'])
+        deadline = time.time() + 5
+        while self.resolved.count('localhost') < 2 and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertGreaterEqual(self.resolved.count('localhost'), 2)
+        # 第二轮的预解析和未缓存域名的查询都不能阻塞
+        self.call(self.cache.prefetch, ['localhost'])
+        with self.assertRaises(socket.gaierror):
+            self.call(self.cache.lookup, 'not-cached.invalid')
+        self.assertEqual(self.call(self.cache.lookup, 'localhost'), '127.0.0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# @FileName：     test_target_list.py
+
+"""
+TargetList：网段、地址范围的解析，去重与合并
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import check_ip  # noqa: E402
+from check_ip import TargetList  # noqa: E402
+
+
+def addr(ip):
+    return check_ip.IPV4_ADDRESS.unpack(check_ip.socket.inet_aton(ip))[0]
+
+
+class ParseTargetTest(unittest.TestCase):
+    def test_single_address(self):
+        self.assertEqual(TargetList.parse_target('10.0.0.1'), (addr('10.0.0.1'), addr('10.0.0.1')))
+
+    def test_network_excludes_network_and_broadcast(self):
+        self.assertEqual(TargetList.parse_target('10.0.0.0/24'), (addr('10.0.0.1'), addr('10.0.0.254')))
+        self.assertEqual(TargetList.parse_target('10.0.0.5/24'), (addr('10.0.0.1'), addr('10.0.0.254')))
+        self.assertEqual(TargetList.parse_target('10.0.0.0/31'), (addr('10.0.0.0'), addr('10.0.0.1')))
+        self.assertEqual(TargetList.parse_target('10.0.0.7/32'), (addr('10.0.0.7'), addr('10.0.0.7')))
+
+    def test_ranges(self):
+        self.assertEqual(TargetList.parse_target('10.0.0.1-10.0.1.5'), (addr('10.0.0.1'), addr('10.0.1.5')))
+        self.assertEqual(TargetList.parse_target('10.0.0.250-255'), (addr('10.0.0.250'), addr('10.0.0.255')))
+
+    def test_invalid_ranges(self):
+        for target in ('10.0.0.1-300', '10.0.0.250-260', '10.0.0.50-10', '10.0.0.50-10.0.0.1', '10.0.0.1-x',
+                       '10.0.0.0/33'):
+            with self.assertRaises(ValueError, msg=target):
+                TargetList.parse_target(target)
+
+    def test_hostnames(self):
+        self.assertIsNone(TargetList.parse_target('example.com'))
+        self.assertIsNone(TargetList.parse_target('my-host.example.com'))
+
+
+class FromFileTest(unittest.TestCase):
+    def load(self, text):
+        with tempfile.NamedTemporaryFile('w', suffix='.iplist', delete=False) as f_ip:
+            f_ip.write(text)
+        self.addCleanup(os.unlink, f_ip.name)
+        return TargetList.from_file(f_ip.name)
+
+    def test_overlaps_are_merged_and_counted(self):
+        targets = self.load("10.0.0.1-10\n10.0.0.5-20\n10.0.0.3\n10.0.0.21\n")
+        self.assertEqual(list(targets.ips()), ['10.0.0.%d' % n for n in range(1, 22)])
+        self.assertEqual(len(targets), 21)
+        self.assertEqual(len(targets.starts), 1)
+        self.assertEqual(targets.duplicates, 7)
+
+    def test_unsorted_input(self):
+        targets = self.load("10.0.1.1\n10.0.0.2\n10.0.0.1\n")
+        self.assertEqual(list(targets.ips()), ['10.0.0.1', '10.0.0.2', '10.0.1.1'])
+
+    def test_options_keep_separate_intervals(self):
+        targets = self.load("@core interval=5\n10.0.0.1-3\n@edge interval=60\n10.0.0.2-5\n")
+        self.assertEqual([(ip, options.get('interval')) for ip, options in targets],
+                         [('10.0.0.1', '5'), ('10.0.0.2', '5'), ('10.0.0.3', '5'),
+                          ('10.0.0.4', '60'), ('10.0.0.5', '60')])
+
+    def test_invalid_lines_are_skipped(self):
+        targets = self.load("10.0.0.1-300\n10.0.0.250-260\n10.0.0.9\n")
+        self.assertEqual(list(targets.ips()), ['10.0.0.9'])
+
+    def test_hostnames_are_deduplicated(self):
+        targets = self.load("example.com\nexample.com # 重复\n10.0.0.1\n")
+        self.assertEqual(list(targets.ips()), ['10.0.0.1', 'example.com'])
+        self.assertEqual(targets.hostnames(), ['example.com'])
+        self.assertEqual(targets.duplicates, 1)
+
+    def test_target_by_index(self):
+        targets = self.load("@edge interval=60\n10.0.0.1-3\n@core interval=5\nexample.com\n10.0.1.0/30\n")
+        entries = list(targets.entries())
+        self.assertEqual([targets.target(index) for index in range(len(targets))], entries)
+        self.assertEqual(entries[-1][0], 'example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()